@@ -0,0 +1,77 @@
+import json
+import os
+
+import soundfile as sf
+
+
+class AudioManifest:
+    """
+    Persistent index of the audio files of the label folders. Each file is stored under its path relative to the
+    audio folder with its label, size, modification time, duration, sample rate and whether it could be read.
+
+    refresh scans the label folders with os.scandir and only opens the files which are new or whose size or
+    modification time changed, so the cost of a refresh after adding N files is N header reads. The loaders then
+    query the manifest instead of listing the folders, which also gives them a stable (sorted) file order and lets
+    them skip the unreadable files without trying to decode them again.
+    """
+
+    def __init__(self, manifest_path, audio_path, labels):
+        self.manifest_path = manifest_path
+        self.audio_path = audio_path
+        self.labels = labels
+        self.entries = {}
+        if os.path.exists(manifest_path):
+            with open(manifest_path) as manifest_file:
+                self.entries = json.load(manifest_file)["files"]
+
+    def refresh(self):
+        """
+        Updates the entries of the new, changed and deleted files and saves the manifest.
+
+        Returns:
+            int -- number of files which were (re)read.
+        """
+        entries = {}
+        num_read_files = 0
+        for label in self.labels:
+            with os.scandir(os.path.join(self.audio_path, label)) as dir_entries:
+                for dir_entry in dir_entries:
+                    if dir_entry.name == ".DS_Store" or not dir_entry.is_file():
+                        continue
+                    relative_path = label + "/" + dir_entry.name
+                    stat = dir_entry.stat()
+                    entry = self.entries.get(relative_path)
+                    if entry is None or entry["size"] != stat.st_size or entry["mtime_ns"] != stat.st_mtime_ns:
+                        entry = self._read_entry(dir_entry.path, label, stat)
+                        num_read_files += 1
+                    entries[relative_path] = entry
+
+        self.entries = entries
+        self.save()
+        return num_read_files
+
+    def save(self):
+        # Write to a temporary file first so that an interrupted run never leaves a truncated manifest behind
+        tmp_path = self.manifest_path + ".tmp"
+        with open(tmp_path, "w") as manifest_file:
+            json.dump({"audio_path": self.audio_path, "files": self.entries}, manifest_file, sort_keys=True)
+        os.replace(tmp_path, self.manifest_path)
+
+    def files(self, label, min_duration=0):
+        """
+        Returns the sorted paths of the readable files of a label which last at least min_duration seconds.
+        """
+        return [
+            os.path.join(self.audio_path, relative_path)
+            for relative_path, entry in sorted(self.entries.items())
+            if entry["label"] == label and entry["readable"] and entry["duration"] >= min_duration
+        ]
+
+    @staticmethod
+    def _read_entry(path, label, stat):
+        entry = {"label": label, "size": stat.st_size, "mtime_ns": stat.st_mtime_ns}
+        try:
+            info = sf.info(path)
+        except RuntimeError:
+            return dict(entry, duration=0, samplerate=None, readable=False)
+        return dict(entry, duration=info.duration, samplerate=info.samplerate, readable=True)
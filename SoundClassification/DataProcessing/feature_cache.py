@@ -0,0 +1,109 @@
+import hashlib
+import json
+import os
+
+import numpy as np
+
+DEFAULT_MAX_SIZE_BYTES = 50 * 1024 ** 3  # 50 GB
+
+
+class FeatureCache:
+    """
+    Content-addressed cache of the features extracted from the audio files. Each entry is a .npy shard named after
+    the hash of the source file (path, size and modification time) and of the parameters used to compute it, so
+    changing a file or any feature parameter makes the old entry unreachable. Entries are loaded memory-mapped.
+
+    The size of the cache is capped: when it is exceeded, the least recently used entries are deleted. The
+    modification time of a shard is used as its last access time.
+    """
+
+    def __init__(self, cache_dir, max_size_bytes=DEFAULT_MAX_SIZE_BYTES):
+        self.cache_dir = cache_dir
+        self.max_size_bytes = max_size_bytes
+        os.makedirs(cache_dir, exist_ok=True)
+        self.size_bytes = sum(entry.stat().st_size for entry in self._entries())
+
+    @staticmethod
+    def make_key(data_path, kind, params):
+        """
+        Returns the key of the features of a file.
+
+        Arguments:
+            data_path {str} -- path to the source audio file.
+            kind {str} -- name of the stored representation, e.g. "raw" or "mfcc".
+            params {dict} -- JSON serialisable parameters used to compute the features.
+
+        Returns:
+            str -- hexadecimal key of the entry.
+        """
+        stat = os.stat(data_path)
+        description = {
+            "path": os.path.abspath(data_path),
+            "size": stat.st_size,
+            "mtime_ns": stat.st_mtime_ns,
+            "kind": kind,
+            "params": params,
+        }
+        return hashlib.sha1(json.dumps(description, sort_keys=True).encode()).hexdigest()
+
+    def get(self, key):
+        """
+        Returns the memory-mapped array stored under key, or None if there is no such entry.
+        """
+        path = self._entry_path(key)
+        try:
+            array = np.load(path, mmap_mode="r")
+        except (FileNotFoundError, ValueError):
+            return None
+        try:
+            os.utime(path)
+        except FileNotFoundError:  # evicted by another process, the mapped array stays readable
+            pass
+        return array
+
+    def put(self, key, array):
+        """
+        Stores array under key and evicts the least recently used entries if the cache became too large.
+        """
+        path = self._entry_path(key)
+        if os.path.exists(path):
+            self.size_bytes -= os.path.getsize(path)
+
+        # Write to a temporary file first so that an interrupted run never leaves a truncated shard behind
+        tmp_path = path + ".tmp"
+        with open(tmp_path, "wb") as file:
+            np.save(file, np.ascontiguousarray(array))
+        os.replace(tmp_path, path)
+
+        self.size_bytes += os.path.getsize(path)
+        if self.size_bytes > self.max_size_bytes:
+            self.evict()
+
+    def evict(self, target_ratio=0.9):
+        """
+        Deletes the least recently used entries until the cache uses at most target_ratio of its maximal size.
+        The margin avoids scanning the cache folder again on every following put. Several processes can share the
+        same folder, so an entry may have been deleted by another one in the meantime.
+        """
+        entries = []
+        for entry in self._entries():
+            try:
+                entries.append((entry.stat().st_mtime, entry.stat().st_size, entry.path))
+            except FileNotFoundError:
+                continue
+        self.size_bytes = sum(size for _, size, _ in entries)
+
+        for _, size, path in sorted(entries):
+            if self.size_bytes <= target_ratio * self.max_size_bytes:
+                break
+            self.size_bytes -= size
+            try:
+                os.remove(path)
+            except FileNotFoundError:
+                pass
+
+    def _entry_path(self, key):
+        return os.path.join(self.cache_dir, key + ".npy")
+
+    def _entries(self):
+        return [entry for entry in os.scandir(self.cache_dir) if entry.name.endswith(".npy")]
@@ -1,14 +1,80 @@
 import numpy as np
 import soundfile as sf
 import librosa
+from math import gcd
+from scipy.signal import resample_poly
 from sklearn.preprocessing import LabelBinarizer
 import os
+from concurrent.futures import ProcessPoolExecutor
 from sklearn.model_selection import train_test_split
 import model_cfg
 from tqdm import tqdm
+from functools import partial
+from SoundClassification.DataProcessing.audio_manifest import AudioManifest
+from SoundClassification.DataProcessing.feature_cache import FeatureCache
+from SoundClassification.DataProcessing import segmentation
 
+LABELS = ["speech", "silence", "singing"]  # order in which the labels are loaded
+CLASSES = sorted(LABELS)  # columns of the one-hot encoded labels, as ordered by the LabelBinarizer
+REPRESENTATIONS = ("raw", "mfcc")
 
-def convert_data_to_mfcc(wave, sampling_rate, max_pad_len=256, padding=True):
+SAMPLE_RATE = 48000  # sample rate of the AudioSet recordings
+RECORDING_DURATION = 10  # duration of the AudioSet recordings in seconds
+
+# Parameters of the windowing (see segmentation.sliding_windows) and of convert_data_to_mfcc. They are part of the keys
+# of the feature cache. By default, 3 windows of 2 seconds are cut every 0.2 seconds after the first 0.2 seconds.
+DEFAULT_FEATURE_PARAMS = {
+    "window_duration": 2,  # in seconds
+    "window_hop": 0.2,  # in seconds, between the starts of two successive windows
+    "start_margin": 0.2,  # in seconds, skipped at the beginning of the recordings
+    "end_margin": 0,  # in seconds, skipped at the end of the recordings
+    "max_windows": 3,  # maximal number of windows per recording, None for all the windows that fit
+    # Working sample rate in hertz. Recordings at another rate are resampled once when they are decoded, e.g. 16000
+    # to divide the size of the raw windows and the mfcc extraction time by 3.
+    "sample_rate": 48000,
+    # The mfcc are zero-padded to a max_pad_len x max_pad_len image. With None, they keep their native
+    # (n_mfcc, frames) shape, e.g. 20 x 188 for 2 seconds, which is 17 times fewer pixels for the models to process.
+    "max_pad_len": 256,
+    "n_mfcc": 20,
+    # n_fft and hop_length are given at 48 000 Hz and are scaled with the working sample rate, so that the frames keep
+    # the same duration and the mfcc the same shape at every sample rate (see get_mfcc_params)
+    "n_fft": 2048,
+    "hop_length": 512,
+    # Compute one spectrogram for all the windows of a file, see convert_windows_to_mfcc. It only applies when the
+    # window hop is a multiple of hop_length, e.g. with a hop_length of 480 (10 ms at 48 000 Hz): with the defaults
+    # (a 9600 samples hop and a hop_length of 512), the windows keep their own spectrogram and the option is a no-op.
+    "shared_stft": False,
+    # Channels kept from the recordings, the mfcc are computed on the first one
+    "channels": [0],
+    # Storage dtypes of the raw windows and of the mfcc windows, see DTYPE_POLICIES
+    "audio_dtype": "float64",
+    "feature_dtype": "float64",
+}
+
+# Parameters which define the decoded (and resampled) span of a recording, see read_windows_span
+AUDIO_PARAMS = (
+    "sample_rate",
+    "window_duration",
+    "window_hop",
+    "start_margin",
+    "end_margin",
+    "max_windows",
+    "audio_dtype",
+)
+
+# Dtype policies of get_train_test_data. The features are always computed in floating point and then stored with
+# feature_dtype. With int16, the raw windows are decoded and cached as 16 bits PCM values (the float value multiplied
+# by 32768) and converted back to float32 samples in [-1, 1) by get_train_test_data, so that the models always see the
+# same scale whatever the policy and the loader.
+DTYPE_POLICIES = {
+    "float64": {"audio_dtype": "float64", "feature_dtype": "float64"},
+    "float32": {"audio_dtype": "float32", "feature_dtype": "float32"},
+    "compact": {"audio_dtype": "int16", "feature_dtype": "float32"},
+    "float16": {"audio_dtype": "int16", "feature_dtype": "float16"},
+}
+
+
+def convert_data_to_mfcc(wave, sampling_rate, max_pad_len=256, padding=True, n_mfcc=20, n_fft=2048, hop_length=512):
     """
     This function converts the wave single which is of dimension (96000, 2) into
     a padded mfcc transform which can then be fed as picture tu the neural network.
@@ -21,13 +87,18 @@ def convert_data_to_mfcc(wave, sampling_rate, max_pad_len=256, padding=True):
         sampling_rate {int} -- sampling rate of the sample.
 
     Keyword Arguments:
-        max_pad_len {int} -- Padding length (default: {256})
+        max_pad_len {int} -- Padding length, None for no padding (default: {256})
         padding {bool} -- Whether padding should be applied (default: {True})
+        n_mfcc {int} -- Number of mfcc coefficients (default: {20})
+        n_fft {int} -- Length of the FFT windows (default: {2048})
+        hop_length {int} -- Number of samples between two successive frames (default: {512})
 
     Returns:
         np.array -- 2d numpy array which is the mfcc transform.
     """
-    mfcc = librosa.feature.mfcc(wave, sr=sampling_rate)
+    mfcc = librosa.feature.mfcc(y=wave, sr=sampling_rate, n_mfcc=n_mfcc, n_fft=n_fft, hop_length=hop_length)
+    if not padding or max_pad_len is None:
+        return mfcc
     pad_width = max_pad_len - mfcc.shape[1]
     pad_height = max_pad_len - mfcc.shape[0]
     return np.pad(
@@ -35,20 +106,115 @@ def convert_data_to_mfcc(wave, sampling_rate, max_pad_len=256, padding=True):
     )  # padding to have consistent mfcc size
 
 
-def shorten_recording(data, samplerate):
+def convert_windows_to_mfcc(
+    data, sampling_rate, offsets, window_length, max_pad_len=256, n_mfcc=20, n_fft=2048, hop_length=512
+):
     """
-    The sample rate is in hertz. It was decided to keep only the 6 seconds in the middle of the audio recording.
+    Computes the padded mfcc of several overlapping windows of the same recording from a single spectrogram.
+    The mel spectrogram is computed once over the span covered by the windows and the frames of each window are
+    sliced out of it. The conversion to decibels and the DCT are then applied per window, like in
+    convert_data_to_mfcc.
+
+    The frames are identical to those of convert_data_to_mfcc except for the frames which are less than n_fft / 2
+    samples away from a window edge that lies inside the span (the first frames of all but the first window and the
+    last frames of all but the last window). There, convert_data_to_mfcc pads the window while this function uses
+    the neighbouring samples of the recording.
+
+    The frames of a window can only be sliced out of the shared spectrogram when the window starts on a frame, so the
+    offsets must be multiples of hop_length apart. This is not the case with the default feature parameters (a 9600
+    samples window hop and a hop_length of 512), for which extract_file_features uses convert_data_to_mfcc instead.
+
+    Arguments:
+        data {np.array} -- 1d wave signal of the whole recording.
+        sampling_rate {int} -- sampling rate of the sample.
+        offsets {list} -- start of each window in samples. They must be multiples of hop_length apart.
+        window_length {int} -- length of each window in samples.
+
+    Keyword Arguments:
+        max_pad_len {int} -- Padding length, None for no padding (default: {256})
+        n_mfcc {int} -- Number of mfcc coefficients (default: {20})
+        n_fft {int} -- Length of the FFT windows (default: {2048})
+        hop_length {int} -- Number of samples between two successive frames (default: {512})
+
+    Returns:
+        np.array -- 3d numpy array with the mfcc transform of each window.
     """
-    duration = 2  # duration in seconds
-    samples_per_n_seconds = samplerate * duration
-    X_samples = np.array([]).reshape(-1, samples_per_n_seconds, 2)
+    if any((offset - offsets[0]) % hop_length for offset in offsets):
+        raise ValueError("The window offsets {} are not multiples of hop_length={} apart".format(offsets, hop_length))
+
+    span = np.asfortranarray(data[offsets[0] : offsets[-1] + window_length])
+    spectrogram = np.abs(librosa.stft(span, n_fft=n_fft, hop_length=hop_length)) ** 2
+    mel_spectrogram = librosa.feature.melspectrogram(S=spectrogram, sr=sampling_rate, n_fft=n_fft)
 
-    for t_start in range(9600, 38400, 9600):
-        X_samples = np.concatenate(
-            (X_samples, data[t_start : t_start + samples_per_n_seconds].reshape(1, samples_per_n_seconds, 2)), axis=0
+    frames_per_window = 1 + window_length // hop_length
+    mfcc_shape = (n_mfcc, frames_per_window) if max_pad_len is None else (max_pad_len, max_pad_len)
+    mfcc = np.zeros((len(offsets),) + mfcc_shape, dtype=mel_spectrogram.dtype)
+    for idx, offset in enumerate(offsets):
+        first_frame = (offset - offsets[0]) // hop_length
+        window_mel_spectrogram = mel_spectrogram[:, first_frame : first_frame + frames_per_window]
+        mfcc[idx, :n_mfcc, :frames_per_window] = librosa.feature.mfcc(
+            S=librosa.power_to_db(window_mel_spectrogram), n_mfcc=n_mfcc
         )
+    return mfcc
 
-    return X_samples
+
+def get_window_params(feature_params, samplerate):
+    """
+    Returns the windowing parameters of feature_params in samples, as keyword arguments of
+    segmentation.sliding_windows and segmentation.count_windows.
+    """
+    return {
+        "window_length": int(round(feature_params["window_duration"] * samplerate)),
+        "hop": int(round(feature_params["window_hop"] * samplerate)),
+        "start_margin": int(round(feature_params["start_margin"] * samplerate)),
+        "end_margin": int(round(feature_params["end_margin"] * samplerate)),
+        "max_windows": feature_params["max_windows"],
+    }
+
+
+def get_mfcc_params(feature_params):
+    """
+    Returns the mfcc parameters of feature_params as keyword arguments of convert_data_to_mfcc, with n_fft and
+    hop_length scaled from 48 000 Hz to the working sample rate. n_fft is kept even since the centered frames of
+    librosa.stft only cover the whole signal with an even n_fft.
+    """
+    scale = feature_params["sample_rate"] / SAMPLE_RATE
+    return {
+        "max_pad_len": feature_params["max_pad_len"],
+        "n_mfcc": feature_params["n_mfcc"],
+        "n_fft": 2 * int(round(feature_params["n_fft"] * scale / 2)),
+        "hop_length": int(round(feature_params["hop_length"] * scale)),
+    }
+
+
+def get_min_duration(feature_params):
+    """
+    Returns the duration in seconds below which no window fits in a recording.
+    """
+    return feature_params["start_margin"] + feature_params["window_duration"] + feature_params["end_margin"]
+
+
+def get_windows_per_file(feature_params=None):
+    """
+    Returns the number of windows cut from a complete AudioSet recording.
+    """
+    feature_params = feature_params or DEFAULT_FEATURE_PARAMS
+    return segmentation.count_windows(
+        RECORDING_DURATION * SAMPLE_RATE, **get_window_params(feature_params, SAMPLE_RATE)
+    )
+
+
+def shorten_recording(data, samplerate, feature_params=None):
+    """
+    Cuts the windows of feature_params out of a whole decoded recording. The sample rate is in hertz. By default,
+    3 windows of 2 seconds are kept, every 0.2 seconds after the first 0.2 seconds, i.e. the samples between 0.2 and
+    2.6 seconds, which is the span that read_windows_span decodes on its own. The windows are returned as a read-only
+    view of data (no copy).
+    """
+    feature_params = feature_params or DEFAULT_FEATURE_PARAMS
+    return segmentation.sliding_windows(
+        data, channels=feature_params["channels"], **get_window_params(feature_params, samplerate)
+    )
 
 
 def apply_mfcc(X, label, sampling_rate=48000):
@@ -61,48 +227,389 @@ def apply_mfcc(X, label, sampling_rate=48000):
     return np.array(mfcc_X), np.array(labels)
 
 
-def build_train_array(label, max_samples=200):
+def pcm_to_float(data):
+    """
+    Converts integer PCM samples to floating point samples in [-1, 1). Floating point samples are returned as is.
+    """
+    if np.issubdtype(data.dtype, np.integer):
+        return data.astype(np.float32) / (np.iinfo(data.dtype).max + 1)
+    return data
 
-    X = np.array([]).reshape(-1, 96000, 2, 1)  # 96 000 is 2 seconds at sample rate 48 000
-    X_mfcc = np.array([]).reshape(-1, 256, 256, 1)
 
-    for filename in tqdm(os.listdir(os.path.join(model_cfg.AUDIOSET_PATH, label))):
-        if filename == ".DS_Store":
-            continue
-        try:
-            data_path = os.path.join(model_cfg.AUDIOSET_PATH, label, filename)
-            data, samplerate = sf.read(data_path)
-        except RuntimeError:
-            continue
+def get_mfcc_shape(feature_params):
+    """
+    Returns the (rows, columns) shape of the mfcc of one window: max_pad_len x max_pad_len, or the native
+    (n_mfcc, frames) shape when max_pad_len is None.
+    """
+    if feature_params["max_pad_len"] is not None:
+        return (feature_params["max_pad_len"], feature_params["max_pad_len"])
+    window_length = get_window_params(feature_params, feature_params["sample_rate"])["window_length"]
+    return (feature_params["n_mfcc"], 1 + window_length // get_mfcc_params(feature_params)["hop_length"])
 
-        # Crop 2 seconds pieces of the audio to train on 2 second files
-        X_samples = shorten_recording(data, samplerate)
-        X = np.concatenate((X, X_samples.reshape(-1, 96000, 2, 1)), axis=0)
 
-        for idx in range(len(X_samples)):
-            X_mfcc_samples = convert_data_to_mfcc(np.asfortranarray(X_samples[idx, :, 0]), samplerate)
-            X_mfcc = np.concatenate((X_mfcc, X_mfcc_samples.reshape(-1, 256, 256, 1)), axis=0)
+def get_sample_shape(is_using_mfcc, feature_params=None):
+    """
+    Returns the shape of one sample as returned by get_train_test_data.
+    """
+    feature_params = feature_params or DEFAULT_FEATURE_PARAMS
+    if is_using_mfcc:
+        return get_mfcc_shape(feature_params) + (1,)
+    return (get_window_params(feature_params, feature_params["sample_rate"])["window_length"], 1)
 
-        if X.shape[0] > max_samples:
-            break
 
-    labels = [label] * X.shape[0]
-    labels_mfcc = [label] * X_mfcc.shape[0]
+class _ArrayBuilder:
+    """
+    Array that is filled in place instead of being grown with np.concatenate. The buffer is allocated once with an
+    estimated capacity and is only reallocated (doubling its size) when the estimate was too small, so appending N
+    samples costs O(N) copies in total instead of O(N^2).
+    """
 
-    return X, X_mfcc, labels, labels_mfcc
+    def __init__(self, sample_shape, capacity, dtype=np.float64):
+        self.buffer = np.empty((capacity,) + tuple(sample_shape), dtype=dtype)
+        self.size = 0
 
+    def append(self, samples):
+        end = self.size + len(samples)
+        if end > len(self.buffer):
+            buffer = np.empty((max(end, 2 * len(self.buffer)),) + self.buffer.shape[1:], dtype=self.buffer.dtype)
+            buffer[: self.size] = self.buffer[: self.size]
+            self.buffer = buffer
+        self.buffer[self.size : end] = samples
+        self.size = end
 
-def get_all_sound_data(max_samples):
-    X_speech, X_mfcc_speech, labels_speech, labels_mfcc_speech = build_train_array("speech", max_samples=max_samples)
-    X_silence, X_mfcc_silence, labels_silence, labels_mfcc_silence = build_train_array(
-        "silence", max_samples=max_samples
-    )
-    X_singing, X_mfcc_singing, labels_singing, labels_mfcc_singing = build_train_array(
-        "singing", max_samples=max_samples
+    def result(self):
+        return self.buffer[: self.size]
+
+
+def resample(data, samplerate, target_samplerate):
+    """
+    Resamples data (samples, channels) with a polyphase filter. Integer PCM samples are resampled in floating point
+    and converted back to their dtype.
+    """
+    divisor = gcd(samplerate, target_samplerate)
+    resampled = resample_poly(pcm_to_float(data), target_samplerate // divisor, samplerate // divisor, axis=0)
+    if np.issubdtype(data.dtype, np.integer):
+        info = np.iinfo(data.dtype)
+        return np.clip(np.round(resampled * (info.max + 1)), info.min, info.max).astype(data.dtype)
+    return resampled.astype(data.dtype)
+
+
+def read_windows_span(data_file, feature_params=None):
+    """
+    Decodes only the part of a recording covered by the windows. The file is seeked to the first window instead of
+    being decoded from its beginning and the decoding stops at the end of the last window. The span is then resampled
+    to the working sample rate if the recording has another one.
+
+    Arguments:
+        data_file {str or file} -- path to the audio file or file object opened in binary mode.
+
+    Keyword Arguments:
+        feature_params {dict} -- Windowing and dtype parameters (default: {DEFAULT_FEATURE_PARAMS})
+
+    Returns:
+        tuple -- the decoded span (samples, channels), starting with the first window, and the working sample rate,
+            or None if no window fits in the recording.
+    """
+    feature_params = feature_params or DEFAULT_FEATURE_PARAMS
+
+    with sf.SoundFile(data_file) as sound_file:
+        samplerate = sound_file.samplerate
+        window_params = get_window_params(feature_params, samplerate)
+        num_windows = segmentation.count_windows(sound_file.frames, **window_params)
+        if num_windows == 0:
+            return None
+        sound_file.seek(window_params["start_margin"])
+        data = sound_file.read(
+            (num_windows - 1) * window_params["hop"] + window_params["window_length"],
+            dtype=feature_params["audio_dtype"],
+            always_2d=True,
+        )
+
+    if samplerate != feature_params["sample_rate"]:
+        data = resample(data, samplerate, feature_params["sample_rate"])
+    return data, feature_params["sample_rate"]
+
+
+_audio_caches = {}  # FeatureCache of the resampled spans of each worker process, by folder
+
+
+def _read_cached_span(data_path, feature_params, cache_dir):
+    """
+    read_windows_span with an on-disk cache of the resampled spans, so that each recording is only resampled once
+    even when the mfcc parameters change. Recordings which are already at the working sample rate are not cached.
+    """
+    if cache_dir is None:
+        return read_windows_span(data_path, feature_params)
+
+    cache = _audio_caches.setdefault(cache_dir, FeatureCache(cache_dir))
+    key = cache.make_key(data_path, "audio", {name: feature_params[name] for name in AUDIO_PARAMS})
+    data = cache.get(key)
+    if data is not None:
+        return data, feature_params["sample_rate"]
+
+    span = read_windows_span(data_path, feature_params)
+    if span is not None and sf.info(data_path).samplerate != feature_params["sample_rate"]:
+        cache.put(key, span[0])
+    return span
+
+
+def extract_file_features(data_path, feature_params=None, representations=REPRESENTATIONS, cache_dir=None):
+    """
+    Decodes a recording and crops it into 2 seconds windows. This is the unit of work that is spread across the
+    worker processes, so it only depends on its arguments.
+
+    Arguments:
+        data_path {str} -- path to the audio file.
+
+    Keyword Arguments:
+        feature_params {dict} -- Windowing and mfcc parameters (default: {DEFAULT_FEATURE_PARAMS})
+        representations {tuple} -- Representations to compute among "raw" and "mfcc" (default: {REPRESENTATIONS})
+        cache_dir {str} -- Folder of the cache of the resampled recordings (default: {None}, no cache)
+
+    Returns:
+        dict -- raw windows (n, window_length, channels, 1) and/or mfcc windows (n, 256, 256, 1) by representation,
+            or None if the file is unreadable or too short.
+    """
+    feature_params = feature_params or DEFAULT_FEATURE_PARAMS
+    try:
+        span = _read_cached_span(data_path, feature_params, cache_dir)
+    except RuntimeError:
+        return None
+    if span is None:
+        return None
+    data, samplerate = span
+
+    # Crop 2 seconds pieces of the audio to train on 2 second files. The span already starts with the first window.
+    window_params = dict(get_window_params(feature_params, samplerate), start_margin=0, end_margin=0)
+    X_samples = segmentation.sliding_windows(data, channels=feature_params["channels"], **window_params)
+    mfcc_params = get_mfcc_params(feature_params)
+    features = {}
+    if "raw" in representations:
+        features["raw"] = X_samples[..., np.newaxis]
+    # The spectrogram can only be shared when the windows start on its frames, see convert_windows_to_mfcc
+    shared_stft = feature_params["shared_stft"] and window_params["hop"] % mfcc_params["hop_length"] == 0
+    if "mfcc" in representations and shared_stft:
+        X_mfcc_samples = convert_windows_to_mfcc(
+            pcm_to_float(data[:, feature_params["channels"][0]]),
+            samplerate,
+            [idx * window_params["hop"] for idx in range(len(X_samples))],
+            window_params["window_length"],
+            **mfcc_params,
+        )
+        features["mfcc"] = X_mfcc_samples[..., np.newaxis].astype(feature_params["feature_dtype"])
+    elif "mfcc" in representations:
+        X_mfcc_samples = np.array(
+            [
+                convert_data_to_mfcc(
+                    np.asfortranarray(pcm_to_float(X_samples[idx, :, 0])),
+                    samplerate,
+                    **mfcc_params,
+                )
+                for idx in range(len(X_samples))
+            ]
+        )
+        features["mfcc"] = X_mfcc_samples[..., np.newaxis].astype(feature_params["feature_dtype"])
+    return features
+
+
+def _extract_files(data_paths, map_function, feature_params, representations, cache):
+    """
+    Yields the features of data_paths in order. Files found in the cache are read from it and only the other files
+    are extracted (with map_function) and then added to the cache.
+    """
+    extract_function = partial(
+        extract_file_features,
+        feature_params=feature_params,
+        representations=representations,
+        cache_dir=cache.cache_dir if cache is not None else None,
     )
+    if cache is None:
+        yield from map_function(extract_function, data_paths)
+        return
+
+    # The librosa version is part of the key since it computes the mfcc
+    params = dict(feature_params, librosa_version=librosa.__version__)
+    keys = [{kind: cache.make_key(path, kind, params) for kind in representations} for path in data_paths]
+    cached_features = [{kind: cache.get(key) for kind, key in file_keys.items()} for file_keys in keys]
+    missing_paths = [
+        path for path, features in zip(data_paths, cached_features) if any(x is None for x in features.values())
+    ]
+    extracted_features = map_function(extract_function, missing_paths)
+
+    for file_keys, features in zip(keys, cached_features):
+        if any(x is None for x in features.values()):
+            features = next(extracted_features)
+            if features is not None:
+                for kind, key in file_keys.items():
+                    cache.put(key, features[kind])
+        yield features
+
+
+def _list_label_files(label, audio_path, feature_params, manifest):
+    if manifest is not None:
+        return manifest.files(label, min_duration=get_min_duration(feature_params))
+    label_path = os.path.join(audio_path or model_cfg.AUDIOSET_PATH, label)
+    return [os.path.join(label_path, filename) for filename in os.listdir(label_path) if filename != ".DS_Store"]
+
+
+def _make_builders(feature_params, representations, capacity):
+    sample_shapes = {
+        "raw": (get_sample_shape(False, feature_params)[0], len(feature_params["channels"]), 1),
+        "mfcc": get_mfcc_shape(feature_params) + (1,),
+    }
+    dtypes = {"raw": feature_params["audio_dtype"], "mfcc": feature_params["feature_dtype"]}
+    return {kind: _ArrayBuilder(sample_shapes[kind], capacity, dtype=dtypes[kind]) for kind in representations}
+
+
+def _open_manifest(manifest_path, audio_path):
+    if manifest_path is None:
+        return None
+    manifest = AudioManifest(manifest_path, audio_path or model_cfg.AUDIOSET_PATH, LABELS)
+    print("{} new or changed audio files".format(manifest.refresh()))
+    return manifest
+
+
+def build_train_array(
+    label,
+    max_samples=200,
+    audio_path=None,
+    executor=None,
+    feature_params=None,
+    cache=None,
+    representations=REPRESENTATIONS,
+    manifest=None,
+):
+    """
+    Builds the raw and mfcc training arrays of a label by cropping each recording into 2 seconds windows.
+    The output arrays are allocated once from the number of files and the number of windows per file and then
+    filled in place.
+
+    When an executor is given, the files are decoded by its workers. Only the files that can still be needed are
+    submitted and the results are merged in the order of the file list, so the output does not depend on the number
+    of workers.
+
+    Arguments:
+        label {str} -- name of the label folder in the AudioSet audio folder.
+
+    Keyword Arguments:
+        max_samples {int} -- The loading stops once more than max_samples windows were loaded (default: {200})
+        audio_path {str} -- Folder containing one sub-folder per label (default: {model_cfg.AUDIOSET_PATH})
+        executor {concurrent.futures.Executor} -- Pool used to extract the files (default: {None}, no pool)
+        feature_params {dict} -- Windowing and mfcc parameters (default: {DEFAULT_FEATURE_PARAMS})
+        cache {FeatureCache} -- Cache of the features of each file (default: {None}, no cache)
+        representations {tuple} -- Representations to build among "raw" and "mfcc" (default: {REPRESENTATIONS})
+        manifest {AudioManifest} -- Index of the audio files, whose readable files long enough for a window are used
+            in sorted order instead of listing the label folder (default: {None}, the folder is listed)
+
+    Returns:
+        tuple -- raw windows (N, window_length, channels, 1), mfcc windows (N, 256, 256, 1) and their two lists of
+            labels. The arrays of the representations which were not requested are None.
+    """
+    map_function = executor.map if executor is not None else map
+    feature_params = feature_params or DEFAULT_FEATURE_PARAMS
+    data_paths = _list_label_files(label, audio_path, feature_params, manifest)
+
+    # The loading stops as soon as more than max_samples windows were collected, which bounds the number of files.
+    windows_per_file = get_windows_per_file(feature_params)
+    capacity = min(len(data_paths), max_samples // windows_per_file + 1) * windows_per_file
+    builders = _make_builders(feature_params, representations, capacity)
+
+    num_windows = 0
+    next_file = 0
+    with tqdm(total=len(data_paths)) as progress_bar:
+        while next_file < len(data_paths) and num_windows <= max_samples:
+            num_files = min((max_samples - num_windows) // windows_per_file + 1, len(data_paths) - next_file)
+            batch_paths = data_paths[next_file : next_file + num_files]
+            next_file += num_files
+
+            for features in _extract_files(batch_paths, map_function, feature_params, representations, cache):
+                progress_bar.update()
+                if features is None:
+                    continue
+                for kind, builder in builders.items():
+                    builder.append(features[kind])
+                num_windows += len(features[representations[0]])
+                if num_windows > max_samples:
+                    break
+
+    X = builders["raw"].result() if "raw" in builders else None
+    X_mfcc = builders["mfcc"].result() if "mfcc" in builders else None
+    labels = [label] * num_windows
+    labels_mfcc = [label] * num_windows
+
+    return X, X_mfcc, labels, labels_mfcc
+
 
-    X = np.concatenate((X_speech, X_silence, X_singing), axis=0)
-    X_mfcc = np.concatenate((X_mfcc_speech, X_mfcc_silence, X_mfcc_singing), axis=0)
+def get_all_sound_data(
+    max_samples,
+    num_workers=1,
+    audio_path=None,
+    feature_params=None,
+    cache_dir=None,
+    representations=REPRESENTATIONS,
+    manifest_path=None,
+):
+    """
+    Loads the speech, silence and singing data (in this order) and one-hot encodes the labels.
+
+    Arguments:
+        max_samples {int} -- maximal number of windows per label, see build_train_array.
+
+    Keyword Arguments:
+        num_workers {int} -- Number of processes extracting the features (default: {1}, no process pool)
+        audio_path {str} -- Folder containing one sub-folder per label (default: {model_cfg.AUDIOSET_PATH})
+        feature_params {dict} -- Windowing and mfcc parameters (default: {DEFAULT_FEATURE_PARAMS})
+        cache_dir {str} -- Folder of the on-disk feature cache (default: {None}, no cache)
+        representations {tuple} -- Representations to build among "raw" and "mfcc" (default: {REPRESENTATIONS})
+        manifest_path {str} -- Path of the AudioManifest of audio_path, which is refreshed and then used to find the
+            files (default: {None}, the label folders are listed)
+
+    Returns:
+        tuple -- raw windows, mfcc windows (None when not requested) and their one-hot encoded labels.
+    """
+    cache = FeatureCache(cache_dir) if cache_dir is not None else None
+    manifest = _open_manifest(manifest_path, audio_path)
+    executor = ProcessPoolExecutor(max_workers=num_workers) if num_workers > 1 else None
+    try:
+        X_speech, X_mfcc_speech, labels_speech, labels_mfcc_speech = build_train_array(
+            "speech",
+            max_samples=max_samples,
+            audio_path=audio_path,
+            executor=executor,
+            feature_params=feature_params,
+            cache=cache,
+            representations=representations,
+            manifest=manifest,
+        )
+        X_silence, X_mfcc_silence, labels_silence, labels_mfcc_silence = build_train_array(
+            "silence",
+            max_samples=max_samples,
+            audio_path=audio_path,
+            executor=executor,
+            feature_params=feature_params,
+            cache=cache,
+            representations=representations,
+            manifest=manifest,
+        )
+        X_singing, X_mfcc_singing, labels_singing, labels_mfcc_singing = build_train_array(
+            "singing",
+            max_samples=max_samples,
+            audio_path=audio_path,
+            executor=executor,
+            feature_params=feature_params,
+            cache=cache,
+            representations=representations,
+            manifest=manifest,
+        )
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    X, X_mfcc = None, None
+    if "raw" in representations:
+        X = np.concatenate((X_speech, X_silence, X_singing), axis=0)
+    if "mfcc" in representations:
+        X_mfcc = np.concatenate((X_mfcc_speech, X_mfcc_silence, X_mfcc_singing), axis=0)
     labels = labels_speech + labels_silence + labels_singing
     labels_mfcc = labels_mfcc_speech + labels_mfcc_silence + labels_mfcc_singing
 
@@ -113,8 +620,141 @@ def get_all_sound_data(max_samples):
     return X, X_mfcc, categorical_label, categorical_label_mfcc
 
 
-def get_train_test_data(test_size=0.2, random_state=1, max_samples=100, is_using_mfcc=False):
-    X, X_mfcc, y_categorical, categorical_label_mfcc = get_all_sound_data(max_samples)
+def get_balanced_sound_data(
+    max_samples,
+    random_state=1,
+    num_workers=1,
+    audio_path=None,
+    feature_params=None,
+    cache_dir=None,
+    representations=REPRESENTATIONS,
+    manifest_path=None,
+):
+    """
+    Samples exactly max_samples windows of every label, with the same outputs as get_all_sound_data.
+
+    The files of each label are visited in a seeded random order. Every round submits, for all the labels at once,
+    just enough files to fill the remaining quotas if all of them are readable, and the windows beyond a quota are
+    dropped. The files which turn out to be unreadable or too short are replaced in the next round, and the reading
+    stops as soon as every quota is filled, so the number of files read is close to the number needed.
+
+    Arguments:
+        max_samples {int} -- number of windows of each label.
+
+    Keyword Arguments:
+        random_state {int} -- Seed of the order of the files (default: {1})
+        See get_all_sound_data for the other arguments.
+
+    Returns:
+        tuple -- raw windows, mfcc windows (None when not requested) and their one-hot encoded labels.
+    """
+    feature_params = feature_params or DEFAULT_FEATURE_PARAMS
+    cache = FeatureCache(cache_dir) if cache_dir is not None else None
+    manifest = _open_manifest(manifest_path, audio_path)
+    random_state = np.random.RandomState(random_state)
+
+    # The files are listed in sorted order before being shuffled so that the sample only depends on the seed
+    file_queues = {}
+    for label in LABELS:
+        data_paths = sorted(_list_label_files(label, audio_path, feature_params, manifest))
+        file_queues[label] = [data_paths[idx] for idx in random_state.permutation(len(data_paths))]
+    builders = {label: _make_builders(feature_params, representations, max_samples) for label in LABELS}
+
+    def get_missing_windows(label):
+        return max_samples - builders[label][representations[0]].size
+
+    windows_per_file = get_windows_per_file(feature_params)
+    executor = ProcessPoolExecutor(max_workers=num_workers) if num_workers > 1 else None
+    map_function = executor.map if executor is not None else map
+    num_read_files = 0
+    try:
+        while True:
+            batch_paths, batch_labels = [], []
+            for label in LABELS:
+                num_files = min(-(-get_missing_windows(label) // windows_per_file), len(file_queues[label]))
+                batch_paths += file_queues[label][:num_files]
+                batch_labels += [label] * num_files
+                del file_queues[label][:num_files]
+            if not batch_paths:
+                break
+            num_read_files += len(batch_paths)
+
+            for label, features in zip(
+                batch_labels, _extract_files(batch_paths, map_function, feature_params, representations, cache)
+            ):
+                if features is None:
+                    continue
+                missing_windows = get_missing_windows(label)
+                for kind, builder in builders[label].items():
+                    builder.append(features[kind][:missing_windows])
+    finally:
+        if executor is not None:
+            executor.shutdown()
+
+    print("{} files read".format(num_read_files))
+    for label in LABELS:
+        if get_missing_windows(label) > 0:
+            print("Only {} windows of {} could be loaded".format(max_samples - get_missing_windows(label), label))
+
+    X, X_mfcc = None, None
+    if "raw" in representations:
+        X = np.concatenate([builders[label]["raw"].result() for label in LABELS], axis=0)
+    if "mfcc" in representations:
+        X_mfcc = np.concatenate([builders[label]["mfcc"].result() for label in LABELS], axis=0)
+    labels = [label for label in LABELS for _ in range(max_samples - get_missing_windows(label))]
+
+    categorical_label = LabelBinarizer().fit_transform(labels)
+    return X, X_mfcc, categorical_label, categorical_label
+
+
+def get_train_test_data(
+    test_size=0.2,
+    random_state=1,
+    max_samples=100,
+    is_using_mfcc=False,
+    num_workers=1,
+    feature_params=None,
+    cache_dir=None,
+    dtype_policy=None,
+    manifest_path=None,
+    is_balanced=False,
+):
+    """
+    Loads the data of all the labels and splits it into a training and a testing set.
+
+    Keyword Arguments:
+        test_size {float} -- Fraction of the windows in the testing set (default: {0.2})
+        random_state {int} -- Seed of the split (default: {1})
+        max_samples {int} -- Maximal number of windows per label, see build_train_array (default: {100})
+        is_using_mfcc {bool} -- Whether the mfcc windows or the raw windows are returned (default: {False})
+        num_workers {int} -- Number of processes extracting the features (default: {1}, no process pool)
+        feature_params {dict} -- Windowing and mfcc parameters (default: {DEFAULT_FEATURE_PARAMS})
+        cache_dir {str} -- Folder of the on-disk feature cache (default: {None}, no cache)
+        dtype_policy {str} -- Name of the storage dtypes in DTYPE_POLICIES, e.g. "compact" for int16 raw windows and
+            float32 mfcc windows. The int16 raw windows are returned as float32 samples in [-1, 1)
+            (default: {None}, the dtypes of feature_params)
+        manifest_path {str} -- Path of the AudioManifest used to find the files (default: {None}, no manifest)
+        is_balanced {bool} -- Whether exactly max_samples windows of each label are sampled from the files in a
+            random order seeded by random_state, see get_balanced_sound_data (default: {False})
+
+    Returns:
+        tuple -- X_train, X_test, y_train, y_test
+    """
+    if dtype_policy is not None:
+        feature_params = dict(feature_params or DEFAULT_FEATURE_PARAMS, **DTYPE_POLICIES[dtype_policy])
+
+    # Only the representation used for the training is built
+    load_function = get_all_sound_data
+    if is_balanced:
+        load_function = partial(get_balanced_sound_data, random_state=random_state)
+    X, X_mfcc, y_categorical, categorical_label_mfcc = load_function(
+        max_samples,
+        num_workers=num_workers,
+        feature_params=feature_params,
+        cache_dir=cache_dir,
+        representations=("mfcc",) if is_using_mfcc else ("raw",),
+        manifest_path=manifest_path,
+    )
 
     if is_using_mfcc:
         X_train, X_test, y_train, y_test = train_test_split(
@@ -124,4 +764,5 @@ def get_train_test_data(test_size=0.2, random_state=1, max_samples=100, is_using
         X_train, X_test, y_train, y_test = train_test_split(
             X[:, :, 0, :], y_categorical, test_size=test_size, random_state=random_state
         )
+        X_train, X_test = pcm_to_float(X_train), pcm_to_float(X_test)
     return X_train, X_test, y_train, y_test
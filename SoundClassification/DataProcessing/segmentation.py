@@ -0,0 +1,54 @@
+import numpy as np
+from numpy.lib.stride_tricks import as_strided
+
+
+def count_windows(num_samples, window_length, hop, start_margin=0, end_margin=0, max_windows=None):
+    """
+    Returns the number of windows of sliding_windows for a recording of num_samples samples.
+    """
+    available_samples = num_samples - start_margin - end_margin
+    num_windows = max(0, (available_samples - window_length) // hop + 1)
+    if max_windows is not None:
+        num_windows = min(num_windows, max_windows)
+    return num_windows
+
+
+def sliding_windows(data, window_length, hop, start_margin=0, end_margin=0, max_windows=None, channels=None):
+    """
+    Cuts a recording into windows of window_length samples which start every hop samples. The windows are returned
+    as a read-only strided view of data, so no sample is copied and overlapping windows share their memory. This is
+    what numpy.lib.stride_tricks.sliding_window_view does, which is not available in numpy 1.18.
+
+    Arguments:
+        data {np.array} -- samples of shape (num_samples,) or (num_samples, num_channels).
+        window_length {int} -- number of samples per window.
+        hop {int} -- number of samples between the starts of two successive windows.
+
+    Keyword Arguments:
+        start_margin {int} -- Number of samples skipped at the beginning of the recording (default: {0})
+        end_margin {int} -- Number of samples skipped at the end of the recording (default: {0})
+        max_windows {int} -- Maximal number of windows (default: {None}, all the windows that fit)
+        channels {list} -- Channels to keep. Evenly spaced channels are selected without a copy (default: {None}, all)
+
+    Returns:
+        np.array -- read-only view of shape (num_windows, window_length) + data.shape[1:].
+    """
+    if channels is not None:
+        data = _select_channels(data, channels)
+
+    num_windows = count_windows(len(data), window_length, hop, start_margin, end_margin, max_windows)
+    data = data[start_margin:]
+    return as_strided(
+        data,
+        shape=(num_windows, window_length) + data.shape[1:],
+        strides=(hop * data.strides[0],) + data.strides,
+        writeable=False,
+    )
+
+
+def _select_channels(data, channels):
+    steps = set(np.diff(channels))
+    if len(steps) <= 1 and all(step > 0 for step in steps):
+        step = steps.pop() if steps else 1
+        return data[:, channels[0] : channels[-1] + 1 : step]
+    return data[:, channels]
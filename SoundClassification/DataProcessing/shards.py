@@ -0,0 +1,207 @@
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+from sklearn.model_selection import train_test_split
+
+from SoundClassification.DataProcessing import load_data
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+MANIFEST_FILENAME = "manifest.json"
+SPLITS = ("train", "test")
+
+
+def write_shards(output_dir, split, X, y, shard_size):
+    """
+    Writes the windows X and their class indices y into .npy shards of shard_size windows each
+    (the last shard may be smaller).
+
+    Returns:
+        list -- description of each shard, as stored in the manifest.
+    """
+    shards = []
+    for shard_idx, start in enumerate(range(0, len(X), shard_size)):
+        features_filename = "{}-features-{:05d}.npy".format(split, shard_idx)
+        labels_filename = "{}-labels-{:05d}.npy".format(split, shard_idx)
+        X_shard, y_shard = X[start : start + shard_size], y[start : start + shard_size]
+        np.save(os.path.join(output_dir, features_filename), np.ascontiguousarray(X_shard))
+        np.save(os.path.join(output_dir, labels_filename), y_shard)
+        shards.append(
+            {
+                "features": features_filename,
+                "labels": labels_filename,
+                "num_samples": len(X_shard),
+                "class_histogram": get_class_histogram(y_shard),
+            }
+        )
+    return shards
+
+
+def get_class_histogram(y):
+    """
+    Returns the number of windows of each class given their class indices.
+    """
+    counts = np.bincount(y, minlength=len(load_data.CLASSES))
+    return {label: int(count) for label, count in zip(load_data.CLASSES, counts)}
+
+
+def export_shards(
+    output_dir,
+    test_size=0.2,
+    random_state=1,
+    max_samples=100,
+    is_using_mfcc=False,
+    shard_size=256,
+    num_workers=1,
+    audio_path=None,
+    feature_params=None,
+    cache_dir=None,
+    dtype_policy=None,
+    manifest_path=None,
+):
+    """
+    Extracts the windows of the training and testing sets (the same split as get_train_test_data) and writes them
+    into fixed-size .npy shards with a JSON manifest. The windows are shuffled before being written so that every
+    shard holds all the classes. The manifest records the number of windows and the class histogram of each shard,
+    the sample shape and dtype, and the feature parameters, so that the shards can be used without the audio files.
+
+    Arguments:
+        output_dir {str} -- Folder of the shards and of the manifest.
+
+    Keyword Arguments:
+        test_size {float} -- Fraction of the windows in the testing set (default: {0.2})
+        random_state {int} -- Seed of the split and of the shuffling (default: {1})
+        max_samples {int} -- Maximal number of windows per label, see build_train_array (default: {100})
+        is_using_mfcc {bool} -- Whether the mfcc windows or the raw windows are exported (default: {False})
+        shard_size {int} -- Number of windows per shard (default: {256})
+        num_workers {int} -- Number of processes extracting the features (default: {1}, no process pool)
+        audio_path {str} -- Folder containing one sub-folder per label (default: {model_cfg.AUDIOSET_PATH})
+        feature_params {dict} -- Windowing and mfcc parameters (default: {DEFAULT_FEATURE_PARAMS})
+        cache_dir {str} -- Folder of the on-disk feature cache (default: {None}, no cache)
+        dtype_policy {str} -- Name of the storage dtypes in DTYPE_POLICIES (default: {None}, those of feature_params)
+        manifest_path {str} -- Path of the AudioManifest used to find the files (default: {None}, no manifest)
+
+    Returns:
+        dict -- the manifest.
+    """
+    feature_params = feature_params or load_data.DEFAULT_FEATURE_PARAMS
+    if dtype_policy is not None:
+        feature_params = dict(feature_params, **load_data.DTYPE_POLICIES[dtype_policy])
+
+    representation = "mfcc" if is_using_mfcc else "raw"
+    X, X_mfcc, y_categorical, y_categorical_mfcc = load_data.get_all_sound_data(
+        max_samples,
+        num_workers=num_workers,
+        audio_path=audio_path,
+        feature_params=feature_params,
+        cache_dir=cache_dir,
+        representations=(representation,),
+        manifest_path=manifest_path,
+    )
+    if is_using_mfcc:
+        X, y_categorical = X_mfcc, y_categorical_mfcc
+    else:
+        X = X[:, :, 0, :]  # same channel as in get_train_test_data
+    y = np.argmax(y_categorical, axis=1).astype(np.uint8)
+
+    os.makedirs(output_dir, exist_ok=True)
+    X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=test_size, random_state=random_state)
+    random_state = np.random.RandomState(random_state)
+    manifest = {
+        "representation": representation,
+        "sample_shape": list(X.shape[1:]),
+        "dtype": str(X.dtype),
+        "classes": load_data.CLASSES,
+        "feature_params": feature_params,
+        "test_size": test_size,
+        "splits": {},
+    }
+    for split, X_split, y_split in (("train", X_train, y_train), ("test", X_test, y_test)):
+        order = random_state.permutation(len(X_split))
+        shards = write_shards(output_dir, split, X_split[order], y_split[order], shard_size)
+        manifest["splits"][split] = {
+            "num_samples": len(X_split),
+            "class_histogram": get_class_histogram(y_split),
+            "shards": shards,
+        }
+
+    # The manifest is written last so that an interrupted export is never mistaken for a complete one
+    with open(os.path.join(output_dir, MANIFEST_FILENAME), "w") as manifest_file:
+        json.dump(manifest, manifest_file, indent=4)
+    return manifest
+
+
+def load_manifest(shard_dir):
+    """
+    Returns the manifest written by export_shards in shard_dir.
+    """
+    with open(os.path.join(shard_dir, MANIFEST_FILENAME)) as manifest_file:
+        return json.load(manifest_file)
+
+
+def make_shard_dataset(
+    shard_dir,
+    split,
+    batch_size,
+    shuffle=True,
+    shuffle_buffer=1024,
+    random_state=None,
+    cycle_length=4,
+):
+    """
+    Builds a tf.data.Dataset which reads the shards of a split with a parallel interleave and yields batches of
+    (features, one-hot labels). cycle_length shards are read concurrently and their windows are interleaved.
+
+    Arguments:
+        shard_dir {str} -- Folder written by export_shards.
+        split {str} -- "train" or "test".
+        batch_size {int} -- number of windows per batch.
+
+    Keyword Arguments:
+        shuffle {bool} -- Whether the shards and the windows are shuffled at each epoch (default: {True})
+        shuffle_buffer {int} -- Number of windows in the shuffle buffer (default: {1024})
+        random_state {int} -- Seed of the shuffling (default: {None})
+        cycle_length {int} -- Number of shards read in parallel (default: {4})
+
+    Returns:
+        tf.data.Dataset -- batches of windows of shape (batch_size,) + manifest["sample_shape"].
+    """
+    manifest = load_manifest(shard_dir)
+    shards = manifest["splits"][split]["shards"]
+    sample_shape = tuple(manifest["sample_shape"])
+    one_hot = np.eye(len(manifest["classes"]), dtype=np.float32)
+
+    def load_shard(features_filename, labels_filename):
+        X = np.load(os.path.join(shard_dir, features_filename.decode()), mmap_mode="r")
+        y = np.load(os.path.join(shard_dir, labels_filename.decode()))
+        # int16 raw windows are stored as PCM values, see load_data.DTYPE_POLICIES
+        return load_data.pcm_to_float(X).astype(np.float32), one_hot[y]
+
+    def read_shard(features_filename, labels_filename):
+        X, y = tf.numpy_function(load_shard, [features_filename, labels_filename], [tf.float32, tf.float32])
+        X.set_shape((None,) + sample_shape)
+        y.set_shape((None, len(manifest["classes"])))
+        return tf.data.Dataset.from_tensor_slices((X, y))
+
+    dataset = tf.data.Dataset.from_tensor_slices(
+        ([shard["features"] for shard in shards], [shard["labels"] for shard in shards])
+    )
+    if shuffle:
+        dataset = dataset.shuffle(len(shards), seed=random_state)
+    dataset = dataset.interleave(read_shard, cycle_length=cycle_length, num_parallel_calls=AUTOTUNE)
+    if shuffle:
+        dataset = dataset.shuffle(shuffle_buffer, seed=random_state)
+    return dataset.batch(batch_size).prefetch(AUTOTUNE)
+
+
+def get_train_test_datasets(shard_dir, batch_size=32, random_state=1):
+    """
+    Shard counterpart of streaming.get_train_test_datasets.
+
+    Returns:
+        tuple -- training and testing tf.data.Dataset, see make_shard_dataset.
+    """
+    train_dataset = make_shard_dataset(shard_dir, "train", batch_size, random_state=random_state)
+    test_dataset = make_shard_dataset(shard_dir, "test", batch_size, shuffle=False)
+    return train_dataset, test_dataset
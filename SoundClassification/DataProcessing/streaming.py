@@ -0,0 +1,291 @@
+import os
+
+import numpy as np
+import tensorflow as tf
+from sklearn.model_selection import train_test_split
+
+import model_cfg
+from SoundClassification.DataProcessing import load_data
+from SoundClassification.DataProcessing.audio_manifest import AudioManifest
+
+AUTOTUNE = tf.data.experimental.AUTOTUNE
+
+
+def list_file_ids(audio_path=None, max_samples=None, feature_params=None, manifest=None):
+    """
+    Lists the audio files of every label without decoding them. The files are sorted so that the list, and
+    therefore the train/test split, is the same on every machine.
+
+    Keyword Arguments:
+        audio_path {str} -- Folder containing one sub-folder per label (default: {model_cfg.AUDIOSET_PATH})
+        max_samples {int} -- Maximal number of windows per label, as in build_train_array (default: {None}, all files)
+        feature_params {dict} -- Windowing and mfcc parameters (default: {DEFAULT_FEATURE_PARAMS})
+        manifest {AudioManifest} -- Index of the audio files, whose unreadable and too short files are skipped
+            (default: {None}, the label folders are listed)
+
+    Returns:
+        tuple -- list of file paths and list of their labels.
+    """
+    audio_path = audio_path or model_cfg.AUDIOSET_PATH
+    feature_params = feature_params or load_data.DEFAULT_FEATURE_PARAMS
+    data_paths, labels = [], []
+    for label in load_data.LABELS:
+        if manifest is not None:
+            label_paths = manifest.files(label, min_duration=load_data.get_min_duration(feature_params))
+        else:
+            label_path = os.path.join(audio_path, label)
+            label_paths = [
+                os.path.join(label_path, filename)
+                for filename in sorted(os.listdir(label_path))
+                if filename != ".DS_Store"
+            ]
+        if max_samples is not None:
+            label_paths = label_paths[: max_samples // load_data.get_windows_per_file(feature_params) + 1]
+        data_paths += label_paths
+        labels += [label] * len(label_paths)
+    return data_paths, labels
+
+
+def make_input_pipeline(
+    dataset,
+    batch_size,
+    shuffle_buffer=None,
+    cache=None,
+    map_function=None,
+    num_parallel_calls=AUTOTUNE,
+    random_state=None,
+):
+    """
+    Batches a dataset of single (features, label) samples with the usual tf.data optimisations, in this order:
+    parallel map of map_function, cache, shuffle, batch and prefetch. map_function is meant for deterministic
+    per-sample transforms (e.g. a normalisation) since its output is cached when a cache is used.
+
+    Arguments:
+        dataset {tf.data.Dataset} -- unbatched samples.
+        batch_size {int} -- number of samples per batch.
+
+    Keyword Arguments:
+        shuffle_buffer {int} -- Number of samples in the shuffle buffer (default: {None}, no shuffling)
+        cache {str} -- "memory" to cache the samples in memory after the first epoch, or the path of a cache file
+            (default: {None}, no cache)
+        map_function {callable} -- Transform applied to each (features, label) pair (default: {None})
+        num_parallel_calls {int} -- Number of samples transformed in parallel (default: {AUTOTUNE})
+        random_state {int} -- Seed of the shuffling (default: {None})
+
+    Returns:
+        tf.data.Dataset -- prefetched batches.
+    """
+    if map_function is not None:
+        dataset = dataset.map(map_function, num_parallel_calls=num_parallel_calls)
+    if cache is not None:
+        dataset = dataset.cache("" if cache == "memory" else cache)
+    if shuffle_buffer:
+        dataset = dataset.shuffle(shuffle_buffer, seed=random_state)
+    return dataset.batch(batch_size).prefetch(AUTOTUNE)
+
+
+def make_array_dataset(X, y, batch_size, **pipeline_options):
+    """
+    Wraps in-memory windows and labels into a tf.data pipeline, see make_input_pipeline for the options.
+    """
+    return make_input_pipeline(tf.data.Dataset.from_tensor_slices((X, y)), batch_size, **pipeline_options)
+
+
+class EpochSeededSequence(tf.keras.utils.Sequence):
+    """
+    Batches of in-memory or memory-mapped windows for model.fit, the Sequence counterpart of make_epoch_seeded_dataset.
+    It yields the batches of the epochs initial_epoch to num_epochs - 1 one after the other. Every epoch visits the
+    windows in the order of a permutation seeded with random_state + epoch, so the order of an epoch does not depend on
+    the epoch at which the training was (re)started. Only the windows of the requested batch are gathered, so no copy
+    of the whole dataset is made and a memory-mapped array is only read batch by batch.
+
+    It must be used with model.fit(steps_per_epoch=sequence.steps_per_epoch, shuffle=False), since Keras would
+    otherwise shuffle the batches itself.
+    """
+
+    def __init__(self, X, y, batch_size, random_state=None, initial_epoch=0, num_epochs=None):
+        """
+        Arguments:
+            X {np.array} -- Windows, e.g. a read-only np.memmap
+            y {np.array} -- One-hot labels of the windows
+            batch_size {int} -- Number of windows per batch
+
+        Keyword Arguments:
+            random_state {int} -- Seed of the order of the windows (default: {None}, the windows are not shuffled)
+            initial_epoch {int} -- Epoch of the first batches, the initial_epoch of model.fit (default: {0})
+            num_epochs {int} -- Epoch at which the batches end, the epochs of model.fit (default: {None}, a single
+                epoch, e.g. for the validation windows)
+        """
+        super().__init__()
+        self.X = X
+        self.y = y
+        self.batch_size = batch_size
+        self.random_state = random_state
+        self.initial_epoch = initial_epoch
+        self.num_epochs = initial_epoch + 1 if num_epochs is None else num_epochs
+        self.steps_per_epoch = -(-len(X) // batch_size)
+        self.epoch = None
+
+    def get_indices(self, epoch):
+        if self.random_state is None:
+            return np.arange(len(self.X))
+        if epoch != self.epoch:
+            self.epoch = epoch
+            self.indices = np.random.RandomState(self.random_state + epoch).permutation(len(self.X))
+        return self.indices
+
+    def __len__(self):
+        return self.steps_per_epoch * (self.num_epochs - self.initial_epoch)
+
+    def __getitem__(self, index):
+        epoch, step = divmod(index, self.steps_per_epoch)
+        indices = self.get_indices(self.initial_epoch + epoch)[step * self.batch_size : (step + 1) * self.batch_size]
+        # In increasing order, which reads a memory-mapped array sequentially
+        indices = np.sort(indices)
+        return np.asarray(self.X[indices]), np.asarray(self.y[indices])
+
+
+def make_epoch_seeded_dataset(
+    X,
+    y,
+    batch_size,
+    random_state,
+    initial_epoch,
+    num_epochs,
+    shuffle_buffer=None,
+    cache=None,
+    map_function=None,
+    num_parallel_calls=AUTOTUNE,
+):
+    """
+    Yields the shuffled batches of the epochs initial_epoch to num_epochs - 1 of in-memory windows. Each epoch is
+    shuffled with the seed random_state + epoch, so the order of an epoch does not depend on the epoch at which the
+    training was (re)started. The dataset must be used with model.fit(steps_per_epoch=ceil(len(X) / batch_size)).
+
+    The other keyword arguments are those of make_input_pipeline, whose map_function and cache are applied before the
+    shuffling of every epoch.
+    """
+    samples = tf.data.Dataset.from_tensor_slices((X, y))
+    if map_function is not None:
+        samples = samples.map(map_function, num_parallel_calls=num_parallel_calls)
+    if cache is not None:
+        samples = samples.cache("" if cache == "memory" else cache)
+    dataset = samples.take(0).batch(batch_size)
+    for epoch in range(initial_epoch, num_epochs):
+        epoch_samples = samples.shuffle(shuffle_buffer, seed=random_state + epoch) if shuffle_buffer else samples
+        dataset = dataset.concatenate(epoch_samples.batch(batch_size))
+    return dataset.prefetch(AUTOTUNE)
+
+
+def make_dataset(
+    data_paths,
+    labels,
+    is_using_mfcc,
+    batch_size,
+    feature_params=None,
+    shuffle=True,
+    shuffle_buffer=256,
+    random_state=None,
+    num_parallel_calls=AUTOTUNE,
+    cache=None,
+    map_function=None,
+):
+    """
+    Builds a tf.data.Dataset which decodes the files lazily and yields batches of (features, one-hot labels).
+    Only the representation used by the model is computed. The files are decoded by a parallel map and the batches
+    are prefetched so that the feature extraction overlaps with the training steps.
+
+    Arguments:
+        data_paths {list} -- paths to the audio files.
+        labels {list} -- label of each file.
+        is_using_mfcc {bool} -- whether the mfcc windows or the raw windows are yielded.
+        batch_size {int} -- number of windows per batch.
+
+    Keyword Arguments:
+        feature_params {dict} -- Windowing and mfcc parameters (default: {DEFAULT_FEATURE_PARAMS})
+        shuffle {bool} -- Whether the files and the windows are shuffled at each epoch (default: {True})
+        shuffle_buffer {int} -- Number of windows in the shuffle buffer (default: {256})
+        random_state {int} -- Seed of the shuffling (default: {None})
+        num_parallel_calls {int} -- Number of files decoded in parallel (default: {AUTOTUNE})
+        cache {str} -- "memory" or the path of a cache file, to decode the files only during the first epoch
+            (default: {None}, the files are decoded at every epoch)
+        map_function {callable} -- Transform applied to each window, see make_input_pipeline (default: {None})
+
+    Returns:
+        tf.data.Dataset -- batches of windows of shape (batch_size,) + get_sample_shape(is_using_mfcc).
+    """
+    representation = "mfcc" if is_using_mfcc else "raw"
+    sample_shape = load_data.get_sample_shape(is_using_mfcc, feature_params)
+    one_hot = np.eye(len(load_data.CLASSES), dtype=np.float32)
+
+    def load_file(data_path, class_index):
+        features = load_data.extract_file_features(
+            data_path.decode(), feature_params=feature_params, representations=(representation,)
+        )
+        if features is None:
+            X = np.zeros((0,) + sample_shape, dtype=np.float32)
+        else:
+            X = features[representation]
+            if not is_using_mfcc:
+                X = load_data.pcm_to_float(X[:, :, 0, :])  # same channel and scale as in get_train_test_data
+        y = np.repeat(one_hot[class_index][np.newaxis], len(X), axis=0)
+        return X.astype(np.float32), y
+
+    def load(data_path, class_index):
+        X, y = tf.numpy_function(load_file, [data_path, class_index], [tf.float32, tf.float32])
+        X.set_shape((None,) + sample_shape)
+        y.set_shape((None, len(load_data.CLASSES)))
+        return X, y
+
+    class_indices = [load_data.CLASSES.index(label) for label in labels]
+    dataset = tf.data.Dataset.from_tensor_slices((data_paths, class_indices))
+    if shuffle:
+        dataset = dataset.shuffle(len(data_paths), seed=random_state)
+    dataset = dataset.map(load, num_parallel_calls=num_parallel_calls).unbatch()
+    # The windows of a file are consecutive after the unbatch, hence the shuffle buffer
+    return make_input_pipeline(
+        dataset,
+        batch_size,
+        shuffle_buffer=shuffle_buffer if shuffle else None,
+        cache=cache,
+        map_function=map_function,
+        num_parallel_calls=num_parallel_calls,
+        random_state=random_state,
+    )
+
+
+def get_train_test_datasets(
+    test_size=0.2,
+    random_state=1,
+    max_samples=None,
+    is_using_mfcc=False,
+    batch_size=32,
+    feature_params=None,
+    audio_path=None,
+    manifest_path=None,
+):
+    """
+    Streaming counterpart of load_data.get_train_test_data. The split is done on the files instead of on the
+    windows, so it is deterministic without loading any data and the windows of a file never end up in both sets.
+
+    Returns:
+        tuple -- training and testing tf.data.Dataset, see make_dataset.
+    """
+    manifest = None
+    if manifest_path is not None:
+        manifest = AudioManifest(manifest_path, audio_path or model_cfg.AUDIOSET_PATH, load_data.LABELS)
+        manifest.refresh()
+    data_paths, labels = list_file_ids(
+        audio_path=audio_path, max_samples=max_samples, feature_params=feature_params, manifest=manifest
+    )
+    train_paths, test_paths, train_labels, test_labels = train_test_split(
+        data_paths, labels, test_size=test_size, random_state=random_state, stratify=labels
+    )
+
+    train_dataset = make_dataset(
+        train_paths, train_labels, is_using_mfcc, batch_size, feature_params=feature_params, random_state=random_state
+    )
+    test_dataset = make_dataset(
+        test_paths, test_labels, is_using_mfcc, batch_size, feature_params=feature_params, shuffle=False
+    )
+    return train_dataset, test_dataset
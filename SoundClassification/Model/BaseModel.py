@@ -3,15 +3,38 @@ import os
 # os.environ["KERAS_BACKEND"] = "plaidml.keras.backend"
 os.environ["KERAS_BACKEND"] = "tensorflow"
 
+import inspect
+import json
+
 import matplotlib.pyplot as plt
+import tensorflow as tf
 
+import lambdaLayerFunctions
 import models
 import model_cfg
+import tflite_utils
+import training_callbacks
+from SoundClassification.DataProcessing import streaming
 
 from keras.callbacks import ModelCheckpoint
 from datetime import datetime
 
 
+def set_thread_pools(intra_op_threads=None, inter_op_threads=None):
+    """
+    Sets the TensorFlow thread pools of set_performance_profile. It must be called before TensorFlow runs its first
+    operation, e.g. before the streaming or shard datasets are built. Setting a pool to its current size does nothing,
+    so that set_performance_profile can be called afterwards with the same settings.
+    """
+    try:
+        if intra_op_threads is not None and intra_op_threads != tf.config.threading.get_intra_op_parallelism_threads():
+            tf.config.threading.set_intra_op_parallelism_threads(intra_op_threads)
+        if inter_op_threads is not None and inter_op_threads != tf.config.threading.get_inter_op_parallelism_threads():
+            tf.config.threading.set_inter_op_parallelism_threads(inter_op_threads)
+    except RuntimeError:
+        print("WARNING: the thread pools were already initialised, set the performance profile earlier")
+
+
 class BaseModel:
     """
     This class defines the base_model and its basic functionalities.
@@ -25,57 +48,235 @@ class BaseModel:
         self.num_labels = num_labels
         self.num_batch_size = num_batch_size
         self.num_epochs = num_epochs
+        self.jit_compile = False
+        self.learning_rate_multiplier = 1
 
-    def define_model(self, model="base"):
-        # Construct model
-        if model == "base":
-            print("LOADING base MODEL")
-            self.model = models.base_model(self.num_rows, self.num_columns, self.num_channels, self.num_labels)
-            self.define_loss_and_optimizer(loss="categorical_crossentropy", metrics=["accuracy"], optimizer="adam")
-        elif model == "lambda_base":
-            print("LOADING base_lambda MODEL")
-            self.model = models.base_lambda_model(self.num_rows, self.num_columns, self.num_channels, self.num_labels)
-            self.define_loss_and_optimizer(loss="categorical_crossentropy", metrics=["accuracy"], optimizer="adam")
-        elif model == "batch_norm":
-            print("LOADING batch_norm MODEL")
-            self.model = models.batch_norm_model(self.num_rows, self.num_columns, self.num_channels, self.num_labels)
-            self.define_loss_and_optimizer(loss="categorical_crossentropy", metrics=["accuracy"], optimizer="adadelta")
-        elif model == "larger_base_model":
-            print("LOADING larger_base_model MODEL")
-            self.model = models.larger_base_model(self.num_rows, self.num_columns, self.num_channels, self.num_labels)
-            self.define_loss_and_optimizer(loss="categorical_crossentropy", metrics=["accuracy"], optimizer="adam")
-        else:
-            assert model in ["base", "batch_norm"], "ERROR: Unknown model " + model
+    def set_performance_profile(
+        self, intra_op_threads=None, inter_op_threads=None, jit_compile=False, batch_size_multiplier=1
+    ):
+        """
+        Tunes the CPU training. It must be called before define_model, and the thread pools can only be set before
+        TensorFlow runs its first operation, which includes building a tf.data.Dataset: call set_thread_pools before
+        building the datasets in that case. oneDNN is enabled by TensorFlow itself (it is on by default since
+        TensorFlow 2.9 on Linux x86) and is controlled by the TF_ENABLE_ONEDNN_OPTS environment variable, which must
+        be set before tensorflow is imported.
+
+        Keyword Arguments:
+            intra_op_threads {int} -- Threads used inside an operation, e.g. a convolution (default: {None}, all cores)
+            inter_op_threads {int} -- Operations run concurrently (default: {None}, chosen by TensorFlow)
+            jit_compile {bool} -- Whether the training step is compiled with XLA (default: {False})
+            batch_size_multiplier {int} -- Factor applied to the batch size, with the learning rate scaled by the same
+                factor (linear scaling rule) so that the training converges similarly. The batched datasets given to
+                train_model must be built with the multiplied batch size, see model_training.py (default: {1})
+        """
+        set_thread_pools(intra_op_threads, inter_op_threads)
+        self.jit_compile = jit_compile
+        self.num_batch_size *= batch_size_multiplier
+        self.learning_rate_multiplier = batch_size_multiplier
+        print("Performance profile:", self.get_performance_profile())
+
+    def get_performance_profile(self):
+        """
+        Returns the settings which influence the training throughput.
+        """
+        return {
+            "intra_op_threads": tf.config.threading.get_intra_op_parallelism_threads() or os.cpu_count(),
+            "inter_op_threads": tf.config.threading.get_inter_op_parallelism_threads(),
+            "onednn": os.environ.get("TF_ENABLE_ONEDNN_OPTS", "default"),
+            "jit_compile": self.jit_compile,
+            "batch_size": self.num_batch_size,
+            "learning_rate_multiplier": self.learning_rate_multiplier,
+            "tensorflow_version": tf.__version__,
+        }
+
+    def define_model(self, model="base", optimizer=None, **model_params):
+        """
+        Builds and compiles one of the architectures of models.py.
+
+        Keyword Arguments:
+            model {str} -- Name of the architecture in models.MODELS (default: {"base"})
+            optimizer {str or tf.keras.optimizers.Optimizer} -- Optimizer overriding the one of the architecture
+                (default: {None}, models.DEFAULT_OPTIMIZERS or adam)
+            model_params -- Keyword arguments of the architecture, e.g. the mfcc parameters of models.base_lambda_model
+        """
+        assert model in models.MODELS, "ERROR: Unknown model " + model
+        print("LOADING {} MODEL".format(model))
+        self.model = models.MODELS[model](
+            self.num_rows, self.num_columns, self.num_channels, self.num_labels, **model_params
+        )
+        self.define_loss_and_optimizer(
+            loss="categorical_crossentropy",
+            metrics=["accuracy"],
+            optimizer=optimizer or models.DEFAULT_OPTIMIZERS.get(model, "adam"),
+        )
 
     def define_loss_and_optimizer(self, loss="categorical_crossentropy", metrics=["accuracy"], optimizer="adam"):
+        if self.learning_rate_multiplier != 1:
+            optimizer = tf.keras.optimizers.get(optimizer)
+            learning_rate = float(tf.keras.backend.get_value(optimizer.learning_rate))
+            optimizer.learning_rate = learning_rate * self.learning_rate_multiplier
+
+        compile_kwargs = {}
+        if self.jit_compile:
+            if "jit_compile" in inspect.signature(self.model.compile).parameters:
+                compile_kwargs["jit_compile"] = True
+            else:
+                # Before TensorFlow 2.8, XLA can only be enabled globally
+                tf.config.optimizer.set_jit(True)
+
         # Compile the model
-        self.model.compile(loss=loss, metrics=metrics, optimizer=optimizer)
+        self.model.compile(loss=loss, metrics=metrics, optimizer=optimizer, **compile_kwargs)
         # Display model architecture summary
         self.model.summary()
 
-    def train_model(self, x_train, y_train, x_val, y_val):
+    def get_fit_data(self, x_train, y_train, x_val, y_val, input_pipeline=None, initial_epoch=None, random_state=1):
+        """
+        Returns the data keyword arguments of model.fit, see train_model. When initial_epoch is given, the arrays are
+        shuffled with a seed per epoch so that a resumed training sees the same batches as an uninterrupted one, also
+        through an input_pipeline (whose own random_state is then replaced by the per-epoch seeds).
+        """
+        if y_train is None:
+            # The datasets are already batched
+            return {"x": x_train, "validation_data": x_val}
+
+        if initial_epoch is not None and input_pipeline is None:
+            # Index permutations gathered batch by batch, without any copy of the arrays
+            sequence = streaming.EpochSeededSequence(
+                x_train, y_train, self.num_batch_size, random_state, initial_epoch, self.num_epochs
+            )
+            return {
+                "x": sequence,
+                "steps_per_epoch": sequence.steps_per_epoch,
+                "shuffle": False,
+                "validation_data": streaming.EpochSeededSequence(x_val, y_val, self.num_batch_size),
+            }
+
+        if initial_epoch is not None:
+            pipeline_options = {key: value for key, value in input_pipeline.items() if key != "random_state"}
+            return {
+                "x": streaming.make_epoch_seeded_dataset(
+                    x_train,
+                    y_train,
+                    self.num_batch_size,
+                    random_state,
+                    initial_epoch,
+                    self.num_epochs,
+                    **pipeline_options,
+                ),
+                "steps_per_epoch": -(-len(x_train) // self.num_batch_size),
+                "validation_data": self.get_validation_dataset(x_val, y_val, input_pipeline),
+            }
+
+        if input_pipeline is not None:
+            return {
+                "x": streaming.make_array_dataset(x_train, y_train, self.num_batch_size, **input_pipeline),
+                "validation_data": self.get_validation_dataset(x_val, y_val, input_pipeline),
+            }
+
+        return {
+            "x": x_train,
+            "y": y_train,
+            "batch_size": self.num_batch_size,
+            "validation_data": (x_val, y_val),
+        }
+
+    def get_validation_dataset(self, x_val, y_val, input_pipeline=None):
+        """
+        Returns the validation batches of get_fit_data. With an input_pipeline, the validation samples are transformed
+        like the training samples but are not shuffled.
+        """
+        if input_pipeline is None:
+            return streaming.make_array_dataset(x_val, y_val, self.num_batch_size)
+        validation_options = dict(input_pipeline, shuffle_buffer=None)
+        if input_pipeline.get("cache") not in (None, "memory"):
+            validation_options["cache"] = input_pipeline["cache"] + ".validation"
+        return streaming.make_array_dataset(x_val, y_val, self.num_batch_size, **validation_options)
+
+    def train_model(
+        self,
+        x_train,
+        y_train,
+        x_val,
+        y_val,
+        input_pipeline=None,
+        checkpoint_dir=None,
+        checkpoint_every=1,
+        resume=False,
+        random_state=1,
+    ):
         """
         Train the model with a checkpoint that saves the model at each step.
 
+        In streaming mode, x_train and x_val are tf.data.Dataset yielding batches of (data, labels) and y_train and
+        y_val are None.
+
         Arguments:
             x_train {np.array} -- Training data. Shape: (N, 256, 256, 1)
             y_train {np.array} -- Training labels. Shape: (N, 3)
             x_val {np.array} -- Validation data. Shape: (N, 256, 256, 1)
             y_val {np.array} -- Validation data. Shape: (N, 256, 256, 1)
+
+        Keyword Arguments:
+            input_pipeline {dict} -- Options of streaming.make_input_pipeline (shuffle_buffer, cache, map_function,
+                num_parallel_calls, random_state) to feed the arrays through a prefetched tf.data pipeline instead of
+                letting Keras slice them (default: {None}, no pipeline)
+            checkpoint_dir {str} -- Folder of the resumable checkpoints (weights, optimizer state and epoch), see
+                training_callbacks.ResumableCheckpoint (default: {None}, only the best model is saved at each
+                improvement)
+            checkpoint_every {int} -- Number of epochs between two resumable checkpoints (default: {1})
+            resume {bool} -- Whether the training resumes from the latest checkpoint in checkpoint_dir. Nothing is
+                trained when the checkpoint has already completed num_epochs epochs (default: {False})
+            random_state {int} -- Seed of the order of the windows and of the Dropout masks with resumable checkpoints
+                (default: {1})
         """
         saved_model_filename = os.path.join(model_cfg.MODEL_PATH, "saved_models/best_model.hdf5")
-        checkpointer = ModelCheckpoint(filepath=saved_model_filename, verbose=1, save_best_only=True)
+        initial_epoch = 0
+        if checkpoint_dir is None:
+            checkpointer = ModelCheckpoint(filepath=saved_model_filename, verbose=1, save_best_only=True)
+        else:
+            checkpointer = training_callbacks.ResumableCheckpoint(
+                self.model, checkpoint_dir, saved_model_filename, save_every=checkpoint_every
+            )
+            if resume:
+                initial_epoch = checkpointer.restore()
+            if initial_epoch >= self.num_epochs:
+                # The checkpoint is the one of a finished training, whose best model is already saved
+                print(
+                    "Nothing to resume: {} of {} epochs completed in {}".format(
+                        initial_epoch, self.num_epochs, checkpoint_dir
+                    )
+                )
+                return
+        # Throughput, input wait, checkpoint write time and memory of every epoch. It must be the first callback.
+        training_metrics = training_callbacks.TrainingMetrics(
+            os.path.join(model_cfg.MODEL_PATH, "saved_models/training_metrics.json"),
+            os.path.join(model_cfg.MODEL_PATH, "saved_models/training_metrics.csv"),
+            self.num_batch_size,
+        )
+        data_kwargs = self.get_fit_data(
+            x_train,
+            y_train,
+            x_val,
+            y_val,
+            input_pipeline=input_pipeline,
+            initial_epoch=initial_epoch if checkpoint_dir is not None else None,
+            random_state=random_state,
+        )
+
+        callbacks = [training_metrics, checkpointer]
+        if checkpoint_dir is not None:
+            # The Dropout masks of a resumed training must be those of an uninterrupted one
+            callbacks.insert(1, training_callbacks.EpochSeeds(random_state))
 
         start = datetime.now()
         history = self.model.fit(
-            x_train,
-            y_train,
-            batch_size=self.num_batch_size,
             epochs=self.num_epochs,
-            validation_data=(x_val, y_val),
-            callbacks=[checkpointer],
+            initial_epoch=initial_epoch,
+            callbacks=callbacks,
             verbose=1,
+            **data_kwargs,
         )
+        fit_duration = datetime.now() - start
 
         # Plot training & validation accuracy values
         plt.plot(history.history['accuracy'])
@@ -102,6 +303,13 @@ class BaseModel:
 
         duration = datetime.now() - start
         print("Training completed in time: ", duration)
+        if y_train is not None:
+            print(
+                "Training throughput: {:.1f} samples/s with {}".format(
+                    len(x_train) * len(history.history["loss"]) / fit_duration.total_seconds(),
+                    self.get_performance_profile(),
+                )
+            )
 
     def eval_model(self, x_train, y_train, x_test, y_test):
         # Evaluating the model on the training and testing set
@@ -111,18 +319,80 @@ class BaseModel:
         score = self.model.evaluate(x_test, y_test, verbose=0)
         print("Testing Accuracy: ", score[1])
 
-    def export_model_to_tf_lite(self, model_library="keras"):
+    def export_model_to_tf_lite(self, model_library="keras", quantization="float32", representative_data=None):
+        """
+        Converts the best model to saved_pb_models_for_android/speech_class_model.tflite.
+
+        Keyword Arguments:
+            model_library {str} -- "keras" to convert the .hdf5 model, otherwise the .hdf5 model is written to
+                saved_models/best_model_saved_model as a SavedModel which is converted (default: {"keras"})
+            quantization {str} -- Post-training quantization, one of tflite_utils.QUANTIZATIONS (default: {"float32"})
+            representative_data {np.array or tf.data.Dataset} -- Training windows from which the int8 calibration
+                samples are drawn (default: {None})
+        """
         import tensorflow as tf
         saved_model_filename = os.path.join(model_cfg.MODEL_PATH, "saved_models/best_model.hdf5")
-        model = tf.keras.models.load_model(saved_model_filename)
+        model = tf.keras.models.load_model(saved_model_filename, custom_objects=lambdaLayerFunctions.CUSTOM_OBJECTS)
         out_dir = os.path.join(model_cfg.MODEL_PATH, "saved_pb_models_for_android")
+        representative_dataset = None
+        if representative_data is not None:
+            representative_dataset = tflite_utils.get_representative_dataset(representative_data)
 
         if model_library == "keras":
             # loads an h5 file
-            converter = tf.lite.TFLiteConverter.from_keras_model(model)
+            tflite_model = tflite_utils.convert_keras_model(model, quantization, representative_dataset)
         else:
-            # loads 2 files from the directory: {saved_model.pbtxt|saved_model.pb}
-            converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_filename)
-        tflite_model = converter.convert()
+            # Writes the best model as a SavedModel directory {saved_model.pb, variables/} and converts it
+            saved_model_dir = os.path.join(model_cfg.MODEL_PATH, "saved_models/best_model_saved_model")
+            if hasattr(model, "export"):
+                # Since Keras 3, model.save only writes .keras files
+                model.export(saved_model_dir)
+            else:
+                model.save(saved_model_dir, save_format="tf")
+            tflite_model = tflite_utils.convert_keras_model(
+                model, quantization, representative_dataset, saved_model_dir=saved_model_dir
+            )
         open(os.path.join(out_dir, "speech_class_model.tflite"), "wb").write(tflite_model)
-        print("Successfully saved keras model to TFlite model.")
+        print("Successfully saved keras model to TFlite model ({} quantization).".format(quantization))
+
+    def report_tf_lite_quantizations(self, representative_data, x_test, y_test=None):
+        """
+        Compares the TFLite conversions of the best model with every quantization of tflite_utils.QUANTIZATIONS on the
+        test windows (accuracy and agreement with the Keras model, size and latency), prints the comparison and writes
+        it to saved_models/tflite_quantizations.json.
+
+        Arguments:
+            representative_data {np.array or tf.data.Dataset} -- Training windows of the int8 calibration
+            x_test {np.array or tf.data.Dataset} -- Test windows, or batches of (windows, labels)
+
+        Keyword Arguments:
+            y_test {np.array} -- One-hot labels of the test windows (default: {None}, x_test is a dataset)
+        """
+        saved_model_filename = os.path.join(model_cfg.MODEL_PATH, "saved_models/best_model.hdf5")
+        model = tf.keras.models.load_model(saved_model_filename, custom_objects=lambdaLayerFunctions.CUSTOM_OBJECTS)
+        if isinstance(x_test, tf.data.Dataset):
+            x_test, y_test = tflite_utils.to_arrays(x_test)
+
+        results = tflite_utils.compare_quantizations(
+            model, x_test, y_test, tflite_utils.get_representative_dataset(representative_data)
+        )
+        with open(os.path.join(model_cfg.MODEL_PATH, "saved_models/tflite_quantizations.json"), "w") as json_file:
+            json.dump(results, json_file, indent=4)
+
+        print(
+            "{:>12} {:>10} {:>10} {:>10} {:>10} {:>12}".format(
+                "quantization", "size [kB]", "accuracy", "keras acc.", "agreement", "latency [ms]"
+            )
+        )
+        for result in results:
+            print(
+                "{:>12} {:>10.1f} {:>10.3f} {:>10.3f} {:>10.3f} {:>12.2f}".format(
+                    result["quantization"],
+                    result["tflite_bytes"] / 1024,
+                    result["test_accuracy"],
+                    result["keras_test_accuracy"],
+                    result["keras_agreement"],
+                    result["latency_ms"],
+                )
+            )
+        return results
@@ -0,0 +1,288 @@
+"""
+Benchmarks of the data loading pipeline of SoundClassification/DataProcessing/load_data.py.
+The script is run like model_training.py (with the PYTHONPATH set by setup_script.sh):
+
+    python SoundClassification/Model/benchmark_data_loading.py
+
+When the AudioSet data was not downloaded, a synthetic dataset of 10 seconds stereo FLAC files is written to a
+temporary folder instead so that the timings can be reproduced on any machine.
+"""
+import io
+import os
+import tempfile
+import time
+
+import numpy as np
+import soundfile as sf
+from tqdm import tqdm
+
+import model_cfg
+from SoundClassification.DataProcessing import load_data
+
+
+class ByteCountingFile(io.FileIO):
+    """
+    File opened in binary mode which counts the number of bytes read from it.
+    """
+
+    def __init__(self, path):
+        super().__init__(path, "rb")
+        self.bytes_read = 0
+
+    def read(self, size=-1):
+        data = super().read(size)
+        self.bytes_read += len(data)
+        return data
+
+    def readinto(self, buffer):
+        size = super().readinto(buffer)
+        self.bytes_read += size or 0
+        return size
+
+
+def write_synthetic_audioset(output_path, labels, num_files, duration=10, samplerate=48000):
+    """
+    Writes num_files random stereo FLAC recordings per label, with the same layout as the AudioSet audio folder.
+    """
+    random_state = np.random.RandomState(1)
+    for label in labels:
+        os.makedirs(os.path.join(output_path, label), exist_ok=True)
+        for idx in range(num_files):
+            data = np.clip(random_state.randn(duration * samplerate, 2) * 0.1, -1, 1)
+            sf.write(os.path.join(output_path, label, "{:05d}.flac".format(idx)), data, samplerate, subtype="PCM_16")
+    return output_path
+
+
+def build_train_array_concatenate(label, max_samples, audio_path):
+    """
+    Reference implementation of build_train_array which grows its arrays with np.concatenate, with the historical
+    windowing of shorten_recording.
+    """
+    X = np.array([]).reshape(-1, 96000, 2, 1)
+    X_mfcc = np.array([]).reshape(-1, 256, 256, 1)
+
+    for filename in tqdm(os.listdir(os.path.join(audio_path, label))):
+        if filename == ".DS_Store":
+            continue
+        try:
+            data, samplerate = sf.read(os.path.join(audio_path, label, filename))
+        except RuntimeError:
+            continue
+
+        X_samples = np.array([]).reshape(-1, 96000, 2)
+        for t_start in range(9600, 38400, 9600):
+            X_samples = np.concatenate((X_samples, data[t_start : t_start + 96000].reshape(1, 96000, 2)), axis=0)
+        X = np.concatenate((X, X_samples.reshape(-1, 96000, 2, 1)), axis=0)
+
+        for idx in range(len(X_samples)):
+            X_mfcc_samples = load_data.convert_data_to_mfcc(np.asfortranarray(X_samples[idx, :, 0]), samplerate)
+            X_mfcc = np.concatenate((X_mfcc, X_mfcc_samples.reshape(-1, 256, 256, 1)), axis=0)
+
+        if X.shape[0] > max_samples:
+            break
+
+    return X, X_mfcc
+
+
+def benchmark_build_train_array(audio_path, max_samples_list, label="speech"):
+    """
+    Prints the build time of the concatenating and of the preallocated builders for each value of max_samples.
+    """
+    # The reference implementation keeps both channels
+    stereo_feature_params = dict(load_data.DEFAULT_FEATURE_PARAMS, channels=[0, 1])
+
+    results = []
+    for max_samples in max_samples_list:
+        start = time.perf_counter()
+        X_reference, X_mfcc_reference = build_train_array_concatenate(label, max_samples, audio_path)
+        concatenate_time = time.perf_counter() - start
+
+        start = time.perf_counter()
+        X, X_mfcc, _, _ = load_data.build_train_array(
+            label, max_samples=max_samples, audio_path=audio_path, feature_params=stereo_feature_params
+        )
+        preallocated_time = time.perf_counter() - start
+
+        assert np.array_equal(X, X_reference) and np.array_equal(X_mfcc, X_mfcc_reference)
+        results.append((max_samples, X.shape[0], concatenate_time, preallocated_time))
+
+    print("{:>12} {:>10} {:>16} {:>16}".format("max_samples", "windows", "concatenate [s]", "preallocated [s]"))
+    for max_samples, num_windows, concatenate_time, preallocated_time in results:
+        print("{:>12} {:>10} {:>16.2f} {:>16.2f}".format(max_samples, num_windows, concatenate_time, preallocated_time))
+    return results
+
+
+def benchmark_num_workers(audio_path, max_samples, num_workers_list):
+    """
+    Prints the time taken by get_all_sound_data for each number of worker processes and checks that the arrays do
+    not depend on it.
+    """
+    reference = None
+    print("{:>12} {:>10}".format("num_workers", "time [s]"))
+    for num_workers in num_workers_list:
+        start = time.perf_counter()
+        arrays = load_data.get_all_sound_data(max_samples, num_workers=num_workers, audio_path=audio_path)
+        print("{:>12} {:>10.2f}".format(num_workers, time.perf_counter() - start))
+
+        if reference is None:
+            reference = arrays
+        assert all(np.array_equal(array, reference_array) for array, reference_array in zip(arrays, reference))
+
+
+def benchmark_shared_stft(audio_path, num_files, label="speech", hop_length=480):
+    """
+    Prints the mfcc extraction time per file with one spectrogram per window and with one shared spectrogram, and
+    the largest difference between both on the interior frames and on the edge frames of the windows.
+    The hop length must divide the window hop (9600 samples).
+    """
+    feature_params = load_data.DEFAULT_FEATURE_PARAMS
+    filenames = sorted(os.listdir(os.path.join(audio_path, label)))[:num_files]
+    edge_frames = feature_params["n_fft"] // (2 * hop_length) + 1
+
+    # The first librosa call compiles its numba functions, which should not be part of the timings
+    load_data.convert_data_to_mfcc(np.zeros(96000), 48000, hop_length=hop_length)
+
+    per_window_time, shared_time, interior_difference, edge_difference = 0, 0, 0, 0
+    for filename in filenames:
+        try:
+            data, samplerate = sf.read(os.path.join(audio_path, label, filename))
+        except RuntimeError:
+            continue
+        window_params = load_data.get_window_params(feature_params, samplerate)
+        window_length = window_params["window_length"]
+
+        start = time.perf_counter()
+        X_samples = load_data.shorten_recording(data, samplerate)
+        per_window_mfcc = np.array(
+            [
+                load_data.convert_data_to_mfcc(np.asfortranarray(window[:, 0]), samplerate, hop_length=hop_length)
+                for window in X_samples
+            ]
+        )
+        per_window_time += time.perf_counter() - start
+
+        start = time.perf_counter()
+        offsets = [window_params["start_margin"] + idx * window_params["hop"] for idx in range(len(X_samples))]
+        shared_mfcc = load_data.convert_windows_to_mfcc(
+            data[:, 0], samplerate, offsets, window_length, hop_length=hop_length
+        )
+        shared_time += time.perf_counter() - start
+
+        num_frames = 1 + window_length // hop_length
+        difference = np.abs(per_window_mfcc - shared_mfcc)[:, :, :num_frames]
+        interior_difference = max(interior_difference, difference[:, :, edge_frames:-edge_frames].max())
+        edge_difference = max(edge_difference, difference.max())
+
+    print("per window spectrograms: {:.1f} ms per file".format(1000 * per_window_time / len(filenames)))
+    print("shared spectrogram:      {:.1f} ms per file".format(1000 * shared_time / len(filenames)))
+    print("speedup: {:.2f}x".format(per_window_time / shared_time))
+    print("largest difference on interior frames: {:.2e}".format(interior_difference))
+    print("largest difference on the {} edge frames: {:.2e}".format(edge_frames, edge_difference))
+
+
+def benchmark_dtype_policies(audio_path, max_samples):
+    """
+    Prints the memory used by the raw and mfcc arrays of get_all_sound_data with each dtype policy.
+    """
+    print("{:>10} {:>14} {:>14} {:>16} {:>10}".format("policy", "raw [MB]", "mfcc [MB]", "per window [kB]", "time [s]"))
+    for dtype_policy, dtypes in load_data.DTYPE_POLICIES.items():
+        feature_params = dict(load_data.DEFAULT_FEATURE_PARAMS, **dtypes)
+        start = time.perf_counter()
+        X, X_mfcc, _, _ = load_data.get_all_sound_data(
+            max_samples, audio_path=audio_path, feature_params=feature_params
+        )
+        duration = time.perf_counter() - start
+        print(
+            "{:>10} {:>14.1f} {:>14.1f} {:>16.1f} {:>10.2f}".format(
+                dtype_policy, X.nbytes / 1e6, X_mfcc.nbytes / 1e6, (X.nbytes + X_mfcc.nbytes) / len(X) / 1e3, duration
+            )
+        )
+
+
+def benchmark_partial_decode(audio_path, label="speech"):
+    """
+    Prints the bytes read and the time taken to decode the files of a label entirely (like sf.read) and to decode
+    only the span covered by the windows with the channel used by the pipeline (like read_windows_span).
+    On a local disk, the page cache should be dropped before running this benchmark to measure cold reads.
+    """
+    label_path = os.path.join(audio_path, label)
+    results = {"full decode": [0, 0.0], "windows span": [0, 0.0]}
+    for filename in sorted(os.listdir(label_path)):
+        try:
+            start = time.perf_counter()
+            with ByteCountingFile(os.path.join(label_path, filename)) as data_file:
+                sf.read(data_file)
+            results["full decode"][0] += data_file.bytes_read
+            results["full decode"][1] += time.perf_counter() - start
+
+            start = time.perf_counter()
+            with ByteCountingFile(os.path.join(label_path, filename)) as data_file:
+                load_data.read_windows_span(data_file)
+            results["windows span"][0] += data_file.bytes_read
+            results["windows span"][1] += time.perf_counter() - start
+        except RuntimeError:
+            continue
+
+    print("{:>14} {:>14} {:>10}".format("decode", "read [MB]", "time [s]"))
+    for name, (bytes_read, duration) in results.items():
+        print("{:>14} {:>14.1f} {:>10.2f}".format(name, bytes_read / 1e6, duration))
+
+
+def benchmark_sample_rates(audio_path, num_files, label="speech", sample_rates=(48000, 16000)):
+    """
+    Prints, for each working sample rate, the extraction time per file of the mfcc windows without any cache and with
+    the resampled recordings already cached, and the size of the raw and mfcc model inputs.
+    """
+    filenames = sorted(os.listdir(os.path.join(audio_path, label)))[:num_files]
+    data_paths = [os.path.join(audio_path, label, filename) for filename in filenames]
+
+    # The first librosa call compiles its numba functions, which should not be part of the timings
+    load_data.extract_file_features(data_paths[0])
+
+    print(
+        "{:>12} {:>14} {:>14} {:>16} {:>12} {:>12}".format(
+            "sample rate", "cold [ms/file]", "warm [ms/file]", "raw input", "raw [kB]", "mfcc frames"
+        )
+    )
+    for sample_rate in sample_rates:
+        feature_params = dict(load_data.DEFAULT_FEATURE_PARAMS, sample_rate=sample_rate)
+        cache_dir = tempfile.mkdtemp()
+        timings = []
+        for _ in range(2):
+            start = time.perf_counter()
+            for data_path in data_paths:
+                features = load_data.extract_file_features(
+                    data_path, feature_params=feature_params, representations=("mfcc",), cache_dir=cache_dir
+                )
+            timings.append(1000 * (time.perf_counter() - start) / len(data_paths))
+
+        raw_shape = load_data.get_sample_shape(False, feature_params)
+        mfcc_params = load_data.get_mfcc_params(feature_params)
+        num_frames = 1 + raw_shape[0] // mfcc_params["hop_length"]
+        assert np.count_nonzero(features["mfcc"][0, 0, :, 0]) == num_frames
+        print(
+            "{:>12} {:>14.1f} {:>14.1f} {:>16} {:>12.1f} {:>12}".format(
+                sample_rate, timings[0], timings[1], str(raw_shape), raw_shape[0] * 2 / 1e3, num_frames
+            )
+        )
+
+
+if __name__ == "__main__":
+
+    max_samples_list = [30, 60, 120, 240, 480]
+    num_workers_list = [1, 2, 4, os.cpu_count()]
+
+    audio_path = model_cfg.AUDIOSET_PATH
+    if not os.path.isdir(audio_path):
+        audio_path = write_synthetic_audioset(
+            tempfile.mkdtemp(),
+            ["speech", "silence", "singing"],
+            num_files=max(max_samples_list) // load_data.get_windows_per_file() + 1,
+        )
+
+    benchmark_build_train_array(audio_path, max_samples_list)
+    benchmark_num_workers(audio_path, max(max_samples_list), num_workers_list)
+    benchmark_shared_stft(audio_path, num_files=50)
+    benchmark_dtype_policies(audio_path, max(max_samples_list))
+    benchmark_partial_decode(audio_path)
+    benchmark_sample_rates(audio_path, num_files=50)
@@ -0,0 +1,177 @@
+"""
+Benchmarks a .tflite model with the TFLite interpreter on CPU and checks that its outputs match those of the Keras model
+it was converted from. The script is run like model_training.py (with the PYTHONPATH set by setup_script.sh):
+
+    python SoundClassification/Model/benchmark_tflite.py --threads 1 2 4 --features X_test.npy
+
+For every number of threads, it reports the 50th, 90th and 99th percentiles of the latency, the throughput and the peak
+memory of the interpreter, each measured in a separate process. It exits with a non-zero status when the outputs of the
+TFLite and Keras models differ by more than --tolerance on the feature set, so that it can guard a release: the
+features are e.g. the X_test.npy saved by hyperparameter_sweep.py, or fixed random windows by default.
+"""
+import argparse
+import json
+import os
+import subprocess
+import sys
+
+import numpy as np
+
+import model_cfg
+
+DEFAULT_TFLITE_PATH = os.path.join(model_cfg.MODEL_PATH, "saved_pb_models_for_android/speech_class_model.tflite")
+DEFAULT_KERAS_PATH = os.path.join(model_cfg.MODEL_PATH, "saved_models/best_model.hdf5")
+
+
+def load_features(features_path, input_shape, num_samples, random_state=0):
+    """
+    Returns the first num_samples windows of the .npy file features_path, or num_samples random windows of
+    input_shape which are the same at every run when features_path is None.
+    """
+    if features_path is None:
+        return np.random.RandomState(random_state).randn(num_samples, *input_shape).astype(np.float32)
+    return np.asarray(np.load(features_path, mmap_mode="r")[:num_samples], dtype=np.float32)
+
+
+def run_benchmark(tflite_path, num_threads, batch_size, num_warmup_runs, num_runs):
+    """
+    Measures the latency of the interpreter with num_threads threads and prints the results as a JSON line. The peak
+    memory is the maximal resident set size of the process, whose increase while the interpreter is created and run is
+    the memory of the interpreter itself.
+    """
+    import tflite_utils
+    import training_callbacks
+
+    peak_rss_before = training_callbacks.get_peak_rss_mb()
+    interpreter = tflite_utils.make_interpreter(tflite_path, num_threads=num_threads, batch_size=batch_size)
+    input_details = interpreter.get_input_details()[0]
+    X = np.random.RandomState(0).randn(*input_details["shape"]).astype(input_details["dtype"])
+    interpreter.set_tensor(input_details["index"], X)
+    latencies = tflite_utils.measure_latencies(interpreter.invoke, num_warmup_runs, num_runs)
+    peak_rss = training_callbacks.get_peak_rss_mb()
+
+    p50, p90, p99 = np.percentile(latencies, [50, 90, 99])
+    print(
+        json.dumps(
+            {
+                "num_threads": num_threads,
+                "batch_size": batch_size,
+                "p50_ms": p50,
+                "p90_ms": p90,
+                "p99_ms": p99,
+                "mean_ms": float(np.mean(latencies)),
+                "samples_per_second": 1000 * batch_size / float(np.mean(latencies)),
+                "peak_rss_mb": peak_rss,
+                "interpreter_rss_mb": peak_rss - peak_rss_before,
+            }
+        )
+    )
+
+
+def benchmark_threads(tflite_path, thread_counts, batch_size, num_warmup_runs, num_runs):
+    """
+    Runs run_benchmark for every number of threads in its own process and returns the results.
+    """
+    results = []
+    for num_threads in thread_counts:
+        arguments = json.dumps([tflite_path, num_threads, batch_size, num_warmup_runs, num_runs])
+        output = subprocess.run(
+            [sys.executable, __file__, "--single", arguments],
+            stdout=subprocess.PIPE,
+            universal_newlines=True,
+            check=True,
+        ).stdout
+        results.append(json.loads(output.strip().splitlines()[-1]))
+    return results
+
+
+def check_parity(tflite_path, keras_path, features_path, num_samples, tolerance):
+    """
+    Compares the outputs of the TFLite model and of the Keras model on the feature set and returns the comparison,
+    whose "passed" entry tells whether they differ by at most tolerance.
+    """
+    import tensorflow as tf
+
+    import lambdaLayerFunctions
+    import tflite_utils
+
+    interpreter = tflite_utils.make_interpreter(tflite_path)
+    X = load_features(features_path, interpreter.get_input_details()[0]["shape"][1:], num_samples)
+    tflite_predictions = tflite_utils.predict_samples(interpreter, X)
+
+    model = tf.keras.models.load_model(keras_path, custom_objects=lambdaLayerFunctions.CUSTOM_OBJECTS, compile=False)
+    keras_predictions = model.predict(X, verbose=0)
+
+    max_abs_difference = float(np.max(np.abs(tflite_predictions - keras_predictions)))
+    return {
+        "num_samples": len(X),
+        "features": features_path or "random",
+        "max_abs_difference": max_abs_difference,
+        "class_agreement": float(
+            np.mean(np.argmax(tflite_predictions, axis=1) == np.argmax(keras_predictions, axis=1))
+        ),
+        "tolerance": tolerance,
+        "passed": max_abs_difference <= tolerance,
+    }
+
+
+def print_results(results, parity):
+    print(
+        "{:>8} {:>6} {:>9} {:>9} {:>9} {:>12} {:>10} {:>14}".format(
+            "threads", "batch", "p50 [ms]", "p90 [ms]", "p99 [ms]", "samples/s", "peak [MB]", "interp. [MB]"
+        )
+    )
+    for result in results:
+        print(
+            "{num_threads:>8} {batch_size:>6} {p50_ms:>9.2f} {p90_ms:>9.2f} {p99_ms:>9.2f} {samples_per_second:>12.1f} "
+            "{peak_rss_mb:>10.1f} {interpreter_rss_mb:>14.1f}".format(**result)
+        )
+    if parity is not None:
+        print(
+            "Parity with Keras on {num_samples} {features} windows: max abs difference {max_abs_difference:.2e} "
+            "(tolerance {tolerance:.0e}), class agreement {class_agreement:.1%}: {status}".format(
+                status="PASSED" if parity["passed"] else "FAILED", **parity
+            )
+        )
+
+
+def parse_arguments(arguments=None):
+    parser = argparse.ArgumentParser(description="Benchmarks a .tflite model and checks its parity with Keras.")
+    parser.add_argument("--tflite", default=DEFAULT_TFLITE_PATH, help="path of the .tflite model")
+    parser.add_argument("--keras", default=DEFAULT_KERAS_PATH, help="Keras model of the parity check")
+    parser.add_argument("--no-parity", action="store_true", help="only benchmark the latency")
+    parser.add_argument("--features", help=".npy windows of the parity check (default: fixed random windows)")
+    parser.add_argument("--num-samples", type=int, default=100, help="windows of the parity check")
+    parser.add_argument(
+        "--tolerance",
+        type=float,
+        default=1e-4,
+        help="maximal absolute difference of the outputs, e.g. 0.1 for the quantized models",
+    )
+    parser.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4], help="numbers of interpreter threads")
+    parser.add_argument("--batch-size", type=int, default=1)
+    parser.add_argument("--warmup", type=int, default=10, help="untimed invocations before the timed ones")
+    parser.add_argument("--runs", type=int, default=200, help="timed invocations")
+    parser.add_argument("--output", help="JSON file to write the results to")
+    return parser.parse_args(arguments)
+
+
+if __name__ == "__main__":
+
+    if sys.argv[1:2] == ["--single"]:
+        # Child process of benchmark_threads
+        run_benchmark(*json.loads(sys.argv[2]))
+        sys.exit()
+
+    args = parse_arguments()
+    results = benchmark_threads(args.tflite, args.threads, args.batch_size, args.warmup, args.runs)
+    parity = None
+    if not args.no_parity:
+        parity = check_parity(args.tflite, args.keras, args.features, args.num_samples, args.tolerance)
+    print_results(results, parity)
+
+    if args.output is not None:
+        with open(args.output, "w") as json_file:
+            json.dump({"tflite": args.tflite, "benchmarks": results, "parity": parity}, json_file, indent=4)
+    if parity is not None and not parity["passed"]:
+        sys.exit(1)
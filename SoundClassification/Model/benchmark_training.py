@@ -0,0 +1,160 @@
+"""
+Benchmarks of the training loop of BaseModel on CPU. The script is run like model_training.py (with the PYTHONPATH set
+by setup_script.sh):
+
+    python SoundClassification/Model/benchmark_training.py
+
+The models are trained on random mfcc-shaped windows so that the timings only depend on the input pipeline and on the
+model, not on the dataset. The CPU performance profiles are each measured in a separate process since the TensorFlow
+thread pools can only be configured once per process.
+"""
+import json
+import os
+import subprocess
+import sys
+
+os.environ["CUDA_VISIBLE_DEVICES"] = "-1"  # the benchmarks measure the CPU training throughput
+
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import BaseModel
+
+
+class EpochTimer(tf.keras.callbacks.Callback):
+    """
+    Records the wall-clock duration of every epoch.
+    """
+
+    def on_train_begin(self, logs=None):
+        self.durations = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self.start = time.perf_counter()
+
+    def on_epoch_end(self, epoch, logs=None):
+        self.durations.append(time.perf_counter() - self.start)
+
+
+def make_random_windows(num_samples, sample_shape=(256, 256, 1), num_labels=3, dtype=np.float32, random_state=1):
+    random_state = np.random.RandomState(random_state)
+    X = random_state.randn(num_samples, *sample_shape).astype(dtype)
+    y = np.eye(num_labels, dtype=np.float32)[random_state.randint(num_labels, size=num_samples)]
+    return X, y
+
+
+def measure_steps_per_second(
+    model_name,
+    X_train,
+    y_train,
+    X_val,
+    y_val,
+    batch_size,
+    num_epochs,
+    input_pipeline=None,
+    performance_profile=None,
+):
+    """
+    Trains a model for num_epochs and returns the number of training steps per second, averaged over the epochs after
+    the first one (which includes the graph tracing). performance_profile holds the keyword arguments of
+    BaseModel.set_performance_profile, which may change the batch size.
+    """
+    base_model = BaseModel.BaseModel(*X_train.shape[1:], y_train.shape[1], num_batch_size=batch_size)
+    if performance_profile is not None:
+        base_model.set_performance_profile(**performance_profile)
+    base_model.define_model(model=model_name)
+    timer = EpochTimer()
+    base_model.model.fit(
+        epochs=num_epochs,
+        callbacks=[timer],
+        verbose=0,
+        **base_model.get_fit_data(X_train, y_train, X_val, y_val, input_pipeline=input_pipeline),
+    )
+    steps_per_epoch = -(-len(X_train) // base_model.num_batch_size)
+    return steps_per_epoch / np.mean(timer.durations[1:])
+
+
+def benchmark_input_pipeline(model_name="larger_base_model", num_samples=512, batch_size=16, num_epochs=4):
+    """
+    Prints the training steps per second of a model fed with numpy arrays (sliced by Keras) and with the tf.data
+    pipelines of BaseModel.train_model.
+    """
+    X, y = make_random_windows(num_samples)
+    X_val, y_val = make_random_windows(num_samples // 8, random_state=2)
+    # Windows stored in float16 (see load_data.DTYPE_POLICIES) and cast back to float32 in the pipeline
+    X_float16, X_val_float16 = X.astype(np.float16), X_val.astype(np.float16)
+
+    def cast_to_float32(features, label):
+        return tf.cast(features, tf.float32), label
+
+    configurations = [
+        ("numpy arrays", X, X_val, None),
+        ("tf.data", X, X_val, {"shuffle_buffer": num_samples}),
+        ("tf.data + cache", X, X_val, {"shuffle_buffer": num_samples, "cache": "memory"}),
+        ("tf.data float16", X_float16, X_val_float16, {"shuffle_buffer": num_samples, "map_function": cast_to_float32}),
+    ]
+
+    print("{:>18} {:>12}".format("input", "steps/s"))
+    for name, X_train, X_validation, input_pipeline in configurations:
+        steps_per_second = measure_steps_per_second(
+            model_name, X_train, y, X_validation, y_val, batch_size, num_epochs, input_pipeline=input_pipeline
+        )
+        print("{:>18} {:>12.2f}".format(name, steps_per_second))
+
+
+def run_cpu_profile(performance_profile, model_name="larger_base_model", num_samples=512, batch_size=16, num_epochs=3):
+    """
+    Measures the training throughput of one performance profile and prints it as a JSON line.
+    """
+    X, y = make_random_windows(num_samples)
+    X_val, y_val = make_random_windows(num_samples // 8, random_state=2)
+    steps_per_second = measure_steps_per_second(
+        model_name, X, y, X_val, y_val, batch_size, num_epochs, performance_profile=performance_profile
+    )
+    batch_size *= performance_profile.get("batch_size_multiplier", 1)
+    print(json.dumps({"steps_per_second": steps_per_second, "samples_per_second": steps_per_second * batch_size}))
+
+
+def benchmark_cpu_profiles(profiles):
+    """
+    Runs every performance profile of BaseModel.set_performance_profile in its own process and prints their training
+    throughput.
+    """
+    print("{:>10} {:>10} {:>6} {:>6} {:>10} {:>12}".format("intra", "inter", "jit", "batch", "steps/s", "samples/s"))
+    for profile in profiles:
+        output = subprocess.run(
+            [sys.executable, __file__, json.dumps(profile)], stdout=subprocess.PIPE, universal_newlines=True, check=True
+        ).stdout
+        result = json.loads(output.strip().splitlines()[-1])
+        print(
+            "{:>10} {:>10} {:>6} {:>6} {:>10.2f} {:>12.1f}".format(
+                str(profile.get("intra_op_threads")),
+                str(profile.get("inter_op_threads")),
+                str(profile.get("jit_compile", False)),
+                "x{}".format(profile.get("batch_size_multiplier", 1)),
+                result["steps_per_second"],
+                result["samples_per_second"],
+            )
+        )
+
+
+if __name__ == "__main__":
+
+    if len(sys.argv) > 1:
+        # Child process of benchmark_cpu_profiles
+        run_cpu_profile(json.loads(sys.argv[1]))
+        sys.exit()
+
+    num_cores = os.cpu_count()
+    benchmark_input_pipeline()
+    benchmark_cpu_profiles(
+        [
+            {},
+            {"intra_op_threads": num_cores, "inter_op_threads": 1},
+            {"intra_op_threads": max(1, num_cores // 2), "inter_op_threads": 2},
+            {"jit_compile": True},
+            {"intra_op_threads": num_cores, "inter_op_threads": 1, "jit_compile": True, "batch_size_multiplier": 4},
+        ]
+    )
@@ -0,0 +1,385 @@
+"""
+Classifies audio files offline with a trained model, e.g. to reprocess an archive of recordings. The script is run like
+model_training.py (with the PYTHONPATH set by setup_script.sh):
+
+    python SoundClassification/Model/classify_audio.py recordings/ long_recording.flac --output-dir predictions
+
+The files (and the audio files of the folders, recursively) are cut into windows like the training recordings, without
+the margins and the limit on the number of windows. Long recordings are split into chunks of --chunk-windows windows,
+which are decoded and converted to features in parallel worker processes, so that the memory does not depend on their
+duration. The model (.hdf5/.h5/.keras for Keras, .tflite for the TFLite interpreter) then classifies the windows in
+batches in the main process. The layout of the features (mfcc padded to a square, native mfcc or raw windows) is the
+one of the input of the model.
+
+The predictions of every window and of every file (mean of the probabilities of its windows) are written to
+windows.csv and files.csv, or to .jsonl files with --format jsonl, and the throughput is reported in hours of audio
+per minute.
+"""
+import argparse
+import collections
+import csv
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+import soundfile as sf
+
+import model_cfg
+from SoundClassification.DataProcessing import load_data
+from SoundClassification.DataProcessing import segmentation
+
+AUDIO_EXTENSIONS = (".flac", ".wav", ".ogg", ".aif", ".aiff")
+
+
+def list_audio_files(paths):
+    """
+    Returns the audio files of paths, the folders being searched recursively, in a sorted order.
+    """
+    audio_files = []
+    for path in paths:
+        if os.path.isdir(path):
+            for folder, _, filenames in os.walk(path):
+                audio_files.extend(
+                    os.path.join(folder, filename)
+                    for filename in filenames
+                    if filename.lower().endswith(AUDIO_EXTENSIONS)
+                )
+        else:
+            audio_files.append(path)
+    return sorted(audio_files)
+
+
+def get_feature_params(input_shape, window_hop=None, sample_rate=None):
+    """
+    Returns the feature parameters of a model input of input_shape: (window_length, 1) raw windows, (max_pad_len,
+    max_pad_len, 1) padded mfcc or (n_mfcc, frames, 1) native mfcc. The windows cover the whole recordings.
+    """
+    feature_params = dict(
+        load_data.DEFAULT_FEATURE_PARAMS,
+        start_margin=0,
+        end_margin=0,
+        max_windows=None,
+        audio_dtype="float32",
+        feature_dtype="float32",
+    )
+    if window_hop is not None:
+        feature_params["window_hop"] = window_hop
+    if sample_rate is not None:
+        feature_params["sample_rate"] = sample_rate
+    if len(input_shape) == 3 and input_shape[0] != input_shape[1]:
+        feature_params["max_pad_len"] = None
+    elif len(input_shape) == 3:
+        feature_params["max_pad_len"] = input_shape[0]
+
+    is_using_mfcc = len(input_shape) == 3
+    if tuple(load_data.get_sample_shape(is_using_mfcc, feature_params)) != tuple(input_shape):
+        raise ValueError(
+            "The model input {} does not match the windows {} of the feature parameters, check --sample-rate".format(
+                tuple(input_shape), load_data.get_sample_shape(is_using_mfcc, feature_params)
+            )
+        )
+    return feature_params, is_using_mfcc
+
+
+def plan_chunks(audio_files, feature_params, chunk_windows):
+    """
+    Returns the chunks (path, first window, number of windows) of every file, and the duration and the number of
+    windows of every file. Only the headers of the files are read, the files whose header cannot be read have an
+    "error" entry and no chunk.
+    """
+    chunks = []
+    file_infos = {}
+    for path in audio_files:
+        try:
+            info = sf.info(path)
+        except RuntimeError as error:
+            print("WARNING: skipping the unreadable file", path)
+            file_infos[path] = {"duration": 0, "num_windows": 0, "error": "{}: {}".format(type(error).__name__, error)}
+            continue
+        num_windows = segmentation.count_windows(
+            info.frames, **load_data.get_window_params(feature_params, info.samplerate)
+        )
+        file_infos[path] = {"duration": info.frames / info.samplerate, "num_windows": num_windows}
+        for first_window in range(0, num_windows, chunk_windows):
+            chunks.append((path, first_window, min(chunk_windows, num_windows - first_window)))
+    return chunks, file_infos
+
+
+def extract_chunk(path, first_window, num_windows, feature_params, is_using_mfcc):
+    """
+    Decodes the windows [first_window, first_window + num_windows) of a recording and returns their features. This is
+    the unit of work of the worker processes. The chunk is resampled on its own, which only changes the samples which
+    are a few filter lengths away from its edges.
+    """
+    with sf.SoundFile(path) as sound_file:
+        samplerate = sound_file.samplerate
+        window_params = load_data.get_window_params(feature_params, samplerate)
+        sound_file.seek(first_window * window_params["hop"])
+        data = sound_file.read(
+            (num_windows - 1) * window_params["hop"] + window_params["window_length"], dtype="float32", always_2d=True
+        )
+    if samplerate != feature_params["sample_rate"]:
+        data = load_data.resample(data, samplerate, feature_params["sample_rate"])
+        samplerate = feature_params["sample_rate"]
+
+    window_params = dict(load_data.get_window_params(feature_params, samplerate), max_windows=num_windows)
+    windows = segmentation.sliding_windows(data, channels=feature_params["channels"][:1], **window_params)
+    if len(windows) < num_windows:
+        raise ValueError(
+            "Only {} of the {} windows could be decoded, the file is truncated".format(len(windows), num_windows)
+        )
+    if not is_using_mfcc:
+        return np.array(windows, dtype=np.float32)
+
+    mfcc_params = load_data.get_mfcc_params(feature_params)
+    if feature_params["shared_stft"]:
+        # One spectrogram for the whole chunk, see load_data.convert_windows_to_mfcc
+        mfcc = load_data.convert_windows_to_mfcc(
+            np.asfortranarray(data[:, feature_params["channels"][0]]),
+            samplerate,
+            [idx * window_params["hop"] for idx in range(len(windows))],
+            window_params["window_length"],
+            **mfcc_params,
+        )
+    else:
+        mfcc = np.array(
+            [
+                load_data.convert_data_to_mfcc(np.asfortranarray(window[:, 0]), samplerate, **mfcc_params)
+                for window in windows
+            ]
+        )
+    return mfcc[..., np.newaxis].astype(np.float32)
+
+
+def try_extract_chunk(path, first_window, num_windows, feature_params, is_using_mfcc):
+    """
+    Returns the features of extract_chunk and None, or None and the error when the chunk cannot be decoded, e.g. in
+    a corrupted or truncated file, so that the other files are still classified.
+    """
+    try:
+        return extract_chunk(path, first_window, num_windows, feature_params, is_using_mfcc), None
+    except (RuntimeError, ValueError, OSError) as error:
+        return None, "{}: {}".format(type(error).__name__, error)
+
+
+def iterate_chunk_features(chunks, feature_params, is_using_mfcc, num_workers):
+    """
+    Yields the chunks with their features and their decoding error, see try_extract_chunk, in the order of chunks. At
+    most 2 * num_workers chunks are decoded ahead, which bounds the memory however many files are classified.
+    """
+    # Workers are spawned rather than forked since the parent process runs TensorFlow
+    with ProcessPoolExecutor(max_workers=num_workers, mp_context=multiprocessing.get_context("spawn")) as executor:
+        pending = collections.deque()
+        for chunk in chunks:
+            pending.append((chunk, executor.submit(try_extract_chunk, *chunk, feature_params, is_using_mfcc)))
+            if len(pending) >= 2 * num_workers:
+                done_chunk, future = pending.popleft()
+                yield (done_chunk,) + future.result()
+        while pending:
+            done_chunk, future = pending.popleft()
+            yield (done_chunk,) + future.result()
+
+
+class KerasClassifier:
+    def __init__(self, model_path):
+        import tensorflow as tf
+
+        import lambdaLayerFunctions
+
+        self.model = tf.keras.models.load_model(
+            model_path, custom_objects=lambdaLayerFunctions.CUSTOM_OBJECTS, compile=False
+        )
+        self.input_shape = tuple(int(dimension) for dimension in self.model.input_shape[1:])
+
+    def predict(self, X):
+        return np.asarray(self.model.predict_on_batch(X))
+
+
+class TFLiteClassifier:
+    def __init__(self, model_path, batch_size, num_threads):
+        import tflite_utils
+
+        self.tflite_utils = tflite_utils
+        self.batch_size = batch_size
+        self.interpreter = tflite_utils.make_interpreter(model_path, num_threads=num_threads, batch_size=batch_size)
+        self.input_shape = tuple(int(dimension) for dimension in self.interpreter.get_input_details()[0]["shape"][1:])
+
+    def predict(self, X):
+        # The input of the interpreter has a fixed batch size, the last batch is padded with zeros
+        num_samples = len(X)
+        if num_samples < self.batch_size:
+            X = np.concatenate([X, np.zeros((self.batch_size - num_samples,) + X.shape[1:], dtype=X.dtype)])
+        return self.tflite_utils.predict(self.interpreter, X)[:num_samples]
+
+
+def load_classifier(model_path, batch_size, num_threads):
+    if model_path.endswith(".tflite"):
+        return TFLiteClassifier(model_path, batch_size, num_threads)
+    return KerasClassifier(model_path)
+
+
+class PredictionWriter:
+    """
+    Writes the predictions of the windows and of the files to windows.{format} and files.{format} in output_dir.
+    """
+
+    def __init__(self, output_dir, output_format, classes):
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_format = output_format
+        self.classes = classes
+        self.files = [
+            open(os.path.join(output_dir, name + "." + output_format), "w", newline="") for name in ("windows", "files")
+        ]
+        if output_format == "csv":
+            self.window_writer, self.file_writer = (csv.writer(output_file) for output_file in self.files)
+            self.window_writer.writerow(["path", "window", "start", "end", "label"] + list(classes))
+            self.file_writer.writerow(["path", "duration", "num_windows", "label", "error"] + list(classes))
+
+    def write_window(self, path, window, start, end, probabilities):
+        label = self.classes[int(np.argmax(probabilities))]
+        if self.output_format == "csv":
+            self.window_writer.writerow([path, window, round(start, 3), round(end, 3), label] + list(probabilities))
+        else:
+            self._write_json(
+                self.files[0],
+                {"path": path, "window": window, "start": start, "end": end, "label": label},
+                probabilities,
+            )
+
+    def write_file(self, path, duration, num_windows, probabilities=None, error=None):
+        """
+        The probabilities and the label are empty for the files which are too short for a single window and for the
+        files which could not be decoded, whose error is given.
+        """
+        label = self.classes[int(np.argmax(probabilities))] if probabilities is not None else None
+        if self.output_format == "csv":
+            probabilities = list(probabilities) if probabilities is not None else [""] * len(self.classes)
+            self.file_writer.writerow([path, round(duration, 3), num_windows, label, error] + probabilities)
+        else:
+            self._write_json(
+                self.files[1],
+                {"path": path, "duration": duration, "num_windows": num_windows, "label": label, "error": error},
+                probabilities,
+            )
+
+    def _write_json(self, output_file, row, probabilities):
+        row["probabilities"] = None
+        if probabilities is not None:
+            row["probabilities"] = dict(zip(self.classes, (float(probability) for probability in probabilities)))
+        output_file.write(json.dumps(row) + "\n")
+
+    def close(self):
+        for output_file in self.files:
+            output_file.close()
+
+
+def classify(chunks, file_infos, classifier, feature_params, is_using_mfcc, writer, batch_size, num_workers):
+    """
+    Classifies the windows of every chunk in batches of batch_size and writes the predictions of the windows and of
+    the files. The chunks of a file are consecutive, so the predictions of a file are written after its last chunk.
+
+    When a chunk cannot be decoded, the remaining chunks of its file are skipped and the file is written with the
+    error and without predictions (the windows of its previous chunks are kept in the window predictions).
+
+    Returns:
+        dict -- the error of every file which could not be classified.
+    """
+    window_duration = feature_params["window_duration"]
+    window_hop = feature_params["window_hop"]
+    file_probabilities = collections.defaultdict(list)
+    written_files = set()
+    errors = {path: file_info["error"] for path, file_info in file_infos.items() if "error" in file_info}
+
+    def flush(batch):
+        probabilities = classifier.predict(np.concatenate([X for _, X in batch]))
+        for (path, first_window, num_windows), _ in batch:
+            for window in range(first_window, first_window + num_windows):
+                start = window * window_hop
+                writer.write_window(path, window, start, start + window_duration, probabilities[0])
+                file_probabilities[path].append(probabilities[0])
+                probabilities = probabilities[1:]
+            if first_window + num_windows == file_infos[path]["num_windows"] and path not in errors:
+                writer.write_file(
+                    path,
+                    file_infos[path]["duration"],
+                    file_infos[path]["num_windows"],
+                    np.mean(file_probabilities.pop(path), axis=0),
+                )
+                written_files.add(path)
+
+    batch = []
+    batch_length = 0
+    for chunk, X, error in iterate_chunk_features(chunks, feature_params, is_using_mfcc, num_workers):
+        if error is not None and chunk[0] not in errors:
+            print("WARNING: {} could not be decoded ({})".format(chunk[0], error))
+            errors[chunk[0]] = error
+        if chunk[0] in errors:
+            continue
+        # A chunk is split between batches so that every batch (but the last one) has batch_size windows
+        while len(X):
+            taken = X[: batch_size - batch_length]
+            batch.append(((chunk[0], chunk[1], len(taken)), taken))
+            batch_length += len(taken)
+            chunk = (chunk[0], chunk[1] + len(taken), chunk[2] - len(taken))
+            X = X[len(taken) :]
+            if batch_length == batch_size:
+                flush(batch)
+                batch, batch_length = [], 0
+    if batch:
+        flush(batch)
+
+    # Files too short for a single window and files which could not be decoded
+    for path, file_info in file_infos.items():
+        if path not in written_files:
+            writer.write_file(path, file_info["duration"], file_info["num_windows"], error=errors.get(path))
+    return errors
+
+
+def parse_arguments(arguments=None):
+    parser = argparse.ArgumentParser(description="Classifies audio files and folders with a trained model.")
+    parser.add_argument("paths", nargs="+", help="audio files and folders of audio files")
+    parser.add_argument(
+        "--model",
+        default=os.path.join(model_cfg.MODEL_PATH, "saved_models/best_model.hdf5"),
+        help="Keras (.hdf5, .h5, .keras) or TFLite (.tflite) model",
+    )
+    parser.add_argument("--output-dir", default="predictions", help="folder of the prediction files")
+    parser.add_argument("--format", choices=("csv", "jsonl"), default="csv")
+    parser.add_argument("--window-hop", type=float, help="seconds between two windows (default: as in training)")
+    parser.add_argument("--sample-rate", type=int, help="working sample rate of the model (default: as in training)")
+    parser.add_argument("--batch-size", type=int, default=256, help="windows per model call")
+    parser.add_argument("--chunk-windows", type=int, default=64, help="windows decoded at once by a worker")
+    parser.add_argument("--num-workers", type=int, default=os.cpu_count(), help="feature extraction processes")
+    parser.add_argument("--num-threads", type=int, default=os.cpu_count(), help="threads of the TFLite interpreter")
+    return parser.parse_args(arguments)
+
+
+if __name__ == "__main__":
+
+    args = parse_arguments()
+    classifier = load_classifier(args.model, args.batch_size, args.num_threads)
+    feature_params, is_using_mfcc = get_feature_params(classifier.input_shape, args.window_hop, args.sample_rate)
+
+    start = time.perf_counter()
+    chunks, file_infos = plan_chunks(list_audio_files(args.paths), feature_params, args.chunk_windows)
+    writer = PredictionWriter(args.output_dir, args.format, load_data.CLASSES)
+    try:
+        errors = classify(
+            chunks, file_infos, classifier, feature_params, is_using_mfcc, writer, args.batch_size, args.num_workers
+        )
+    finally:
+        writer.close()
+    duration = time.perf_counter() - start
+
+    audio_hours = sum(file_info["duration"] for path, file_info in file_infos.items() if path not in errors) / 3600
+    num_windows = sum(file_info["num_windows"] for path, file_info in file_infos.items() if path not in errors)
+    print(
+        "Classified {} windows of {} files ({:.2f} hours of audio) in {:.1f} s: {:.2f} audio hours per minute".format(
+            num_windows, len(file_infos) - len(errors), audio_hours, duration, audio_hours / (duration / 60)
+        )
+    )
+    if errors:
+        print("{} files could not be decoded, see the error column of the file predictions".format(len(errors)))
@@ -0,0 +1,85 @@
+"""
+Compares the mfcc padded to a 256x256 image (max_pad_len=256) with the native (n_mfcc, frames) mfcc (max_pad_len=None)
+on the same recordings: test accuracy, training time per epoch, and Keras and TFLite latency of every architecture.
+The script is run like model_training.py (with the PYTHONPATH set by setup_script.sh):
+
+    python SoundClassification/Model/compare_feature_layouts.py
+
+The trials are run with hyperparameter_sweep.run_sweep and the results written to saved_models/feature_layouts.csv.
+"""
+import csv
+import os
+
+import model_cfg
+import hyperparameter_sweep
+from SoundClassification.DataProcessing import load_data
+
+LAYOUTS = {"padded": 256, "native": None}
+
+
+def compare_layouts(grid, num_parallel_trials, threads_per_trial, **data_kwargs):
+    """
+    Trains the grid of hyperparameter_sweep.run_sweep on the features of every layout of LAYOUTS and returns the
+    results, each with its layout and sample shape.
+    """
+    results = []
+    for layout, max_pad_len in LAYOUTS.items():
+        feature_params = dict(load_data.DEFAULT_FEATURE_PARAMS, max_pad_len=max_pad_len)
+        array_paths = hyperparameter_sweep.export_features(
+            os.path.join(model_cfg.FEATURE_CACHE_PATH, "sweep-" + layout),
+            is_using_mfcc=True,
+            feature_params=feature_params,
+            **data_kwargs,
+        )
+        sample_shape = "x".join(str(dimension) for dimension in load_data.get_sample_shape(True, feature_params))
+        for result in hyperparameter_sweep.run_sweep(
+            array_paths, grid, num_parallel_trials, threads_per_trial, is_measuring_tflite=True
+        ):
+            results.append(dict({"layout": layout, "sample_shape": sample_shape}, **result))
+    return results
+
+
+def write_comparison(results, csv_path):
+    with open(csv_path, "w", newline="") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
+
+    print(
+        "{:>18} {:>7} {:>11} {:>9} {:>10} {:>11} {:>12}".format(
+            "model", "layout", "shape", "accuracy", "epoch [s]", "keras [ms]", "tflite [ms]"
+        )
+    )
+    for result in sorted(results, key=lambda result: (result["model"], result["layout"])):
+        print(
+            "{model:>18} {layout:>7} {sample_shape:>11} {test_accuracy:>9.3f} {epoch_time_s:>10.2f} "
+            "{latency_ms:>11.2f} {tflite_latency_ms:>12.2f}".format(**result)
+        )
+
+
+if __name__ == "__main__":
+
+    # batch_norm is left out: the TFLite conversion of its 256x256 variant (244M parameters) does not fit in memory
+    grid = {
+        "model": ["base", "larger_base_model", "separable"],
+        "batch_size": [16],
+        "epochs": [10],
+        "optimizer": ["adam"],
+    }
+    num_parallel_trials = 2
+    threads_per_trial = max(1, os.cpu_count() // num_parallel_trials)
+
+    results = compare_layouts(
+        grid,
+        num_parallel_trials,
+        threads_per_trial,
+        test_size=0.1,
+        random_state=1,
+        max_samples=2500,
+        num_workers=os.cpu_count(),
+        cache_dir=model_cfg.FEATURE_CACHE_PATH,
+        dtype_policy="compact",
+        manifest_path=model_cfg.AUDIO_MANIFEST_PATH,
+        is_balanced=True,
+    )
+    write_comparison(results, os.path.join(model_cfg.MODEL_PATH, "saved_models/feature_layouts.csv"))
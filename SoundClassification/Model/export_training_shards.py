@@ -0,0 +1,48 @@
+"""
+Extracts the training and testing windows once and writes them into .npy shards with a JSON manifest, see
+SoundClassification/DataProcessing/shards.py. model_training.py then trains from the shards (shard_dir) without
+decoding any audio file. The parameters below must match those of model_training.py.
+"""
+import os
+
+import model_cfg
+from SoundClassification.DataProcessing import load_data
+from SoundClassification.DataProcessing import shards
+
+
+if __name__ == "__main__":
+
+    random_seed = 1
+    test_size = 0.1
+    max_samples = 2500
+    is_using_mfcc = True
+    shard_size = 256  # windows per shard
+    num_workers = os.cpu_count()
+    cache_dir = model_cfg.FEATURE_CACHE_PATH
+    manifest_path = model_cfg.AUDIO_MANIFEST_PATH
+    dtype_policy = "compact"
+    feature_params = dict(load_data.DEFAULT_FEATURE_PARAMS, sample_rate=48000)
+    output_dir = model_cfg.TRAINING_SHARDS_PATH
+
+    manifest = shards.export_shards(
+        output_dir,
+        test_size=test_size,
+        random_state=random_seed,
+        max_samples=max_samples,
+        is_using_mfcc=is_using_mfcc,
+        shard_size=shard_size,
+        num_workers=num_workers,
+        feature_params=feature_params,
+        cache_dir=cache_dir,
+        dtype_policy=dtype_policy,
+        manifest_path=manifest_path,
+    )
+    for split in shards.SPLITS:
+        print(
+            "{}: {} windows in {} shards, {}".format(
+                split,
+                manifest["splits"][split]["num_samples"],
+                len(manifest["splits"][split]["shards"]),
+                manifest["splits"][split]["class_histogram"],
+            )
+        )
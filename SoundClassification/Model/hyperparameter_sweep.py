@@ -0,0 +1,187 @@
+"""
+Trains every combination of a grid of architectures, batch sizes, numbers of epochs and optimizers and writes a table of
+their accuracy, training time and latency to saved_models/sweep_results.csv. The script is run like model_training.py
+(with the PYTHONPATH set by setup_script.sh):
+
+    python SoundClassification/Model/hyperparameter_sweep.py
+
+The features are extracted once and saved as .npy files which every trial memory-maps read-only, so the trials share
+the same pages of the page cache instead of each holding a copy. The trials run in parallel worker processes, each with
+a fixed number of TensorFlow threads so that they do not oversubscribe the cores.
+"""
+import csv
+import itertools
+import json
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+
+import numpy as np
+
+import model_cfg
+from SoundClassification.DataProcessing import load_data
+
+ARRAY_NAMES = ("X_train", "X_test", "y_train", "y_test")
+
+
+def export_features(sweep_dir, **data_kwargs):
+    """
+    Saves the arrays of load_data.get_train_test_data (called with data_kwargs) as .npy files in sweep_dir, unless they
+    were already saved by a previous sweep with the same data_kwargs. The data_kwargs of the arrays are stored next to
+    them in data_kwargs.json, which is written last so that an interrupted export is redone.
+    """
+    os.makedirs(sweep_dir, exist_ok=True)
+    paths = {name: os.path.join(sweep_dir, name + ".npy") for name in ARRAY_NAMES}
+    kwargs_path = os.path.join(sweep_dir, "data_kwargs.json")
+    # Round trip through JSON so that e.g. the tuples compare equal to the stored lists
+    description = json.loads(json.dumps(data_kwargs, sort_keys=True, default=str))
+    if os.path.exists(kwargs_path) and all(os.path.exists(path) for path in paths.values()):
+        with open(kwargs_path) as json_file:
+            if json.load(json_file) == description:
+                return paths
+        print("The features of {} were extracted with other parameters, extracting them again".format(sweep_dir))
+
+    if os.path.exists(kwargs_path):
+        os.remove(kwargs_path)
+    for name, array in zip(ARRAY_NAMES, load_data.get_train_test_data(**data_kwargs)):
+        np.save(paths[name], array)
+    with open(kwargs_path, "w") as json_file:
+        json.dump(description, json_file, indent=4, sort_keys=True)
+    return paths
+
+
+def init_worker(num_threads):
+    # Must run before TensorFlow is imported by the trials of this worker
+    os.environ["OMP_NUM_THREADS"] = str(num_threads)
+    import tensorflow as tf
+
+    tf.config.threading.set_intra_op_parallelism_threads(num_threads)
+    tf.config.threading.set_inter_op_parallelism_threads(1)
+
+
+def run_trial(array_paths, model_name, batch_size, num_epochs, optimizer, is_measuring_tflite=False):
+    """
+    Trains one configuration on the memory-mapped features and returns its results. With is_measuring_tflite, the
+    trained model is also converted to TFLite to measure its interpreter latency and its size.
+    """
+    import BaseModel
+    import benchmark_training
+    import profile_models
+    import tflite_utils
+    from SoundClassification.DataProcessing import streaming
+
+    X_train, X_test, y_train, y_test = (np.load(array_paths[name], mmap_mode="r") for name in ARRAY_NAMES)
+    base_model = BaseModel.BaseModel(*X_train.shape[1:], y_train.shape[1], num_batch_size=batch_size, num_epochs=1)
+    base_model.define_model(model=model_name, optimizer=optimizer)
+
+    # The memory-mapped windows are gathered batch by batch: given the arrays themselves, Keras would copy them into
+    # tensors private to the process
+    train_sequence = streaming.EpochSeededSequence(X_train, y_train, batch_size, random_state=1, num_epochs=num_epochs)
+    timer = benchmark_training.EpochTimer()
+    start = time.perf_counter()
+    base_model.model.fit(
+        train_sequence,
+        steps_per_epoch=train_sequence.steps_per_epoch,
+        epochs=num_epochs,
+        shuffle=False,
+        callbacks=[timer],
+        verbose=0,
+    )
+    training_time = time.perf_counter() - start
+
+    _, test_accuracy = base_model.model.evaluate(streaming.EpochSeededSequence(X_test, y_test, batch_size), verbose=0)
+    result = {
+        "model": model_name,
+        "batch_size": batch_size,
+        "epochs": num_epochs,
+        "optimizer": optimizer,
+        "test_accuracy": float(test_accuracy),
+        "training_time_s": training_time,
+        "epoch_time_s": float(np.median(timer.durations)),
+        "latency_ms": profile_models.measure_keras_latency(base_model.model, X_test[:1]),
+        "num_params": base_model.model.count_params(),
+    }
+    if is_measuring_tflite:
+        tflite_model = tflite_utils.convert_keras_model(base_model.model)
+        result["tflite_latency_ms"] = tflite_utils.measure_interpreter_latency(
+            tflite_utils.make_interpreter(tflite_model)
+        )
+        result["tflite_bytes"] = len(tflite_model)
+    return result
+
+
+def run_sweep(array_paths, grid, num_parallel_trials, threads_per_trial, is_measuring_tflite=False):
+    """
+    Runs the trials of every combination of the grid, num_parallel_trials at a time, and returns their results in the
+    order of the grid.
+
+    Arguments:
+        array_paths {dict} -- paths of the .npy files written by export_features.
+        grid {dict} -- lists of values of "model", "batch_size", "epochs" and "optimizer".
+        num_parallel_trials {int} -- number of worker processes.
+        threads_per_trial {int} -- number of TensorFlow threads of each worker.
+
+    Keyword Arguments:
+        is_measuring_tflite {bool} -- Whether the TFLite latency and size are measured, see run_trial
+            (default: {False})
+    """
+    combinations = list(itertools.product(grid["model"], grid["batch_size"], grid["epochs"], grid["optimizer"]))
+    # Workers are spawned rather than forked so that they start without any TensorFlow state
+    with ProcessPoolExecutor(
+        max_workers=num_parallel_trials,
+        mp_context=multiprocessing.get_context("spawn"),
+        initializer=init_worker,
+        initargs=(threads_per_trial,),
+    ) as executor:
+        futures = [
+            executor.submit(run_trial, array_paths, *combination, is_measuring_tflite=is_measuring_tflite)
+            for combination in combinations
+        ]
+        return [future.result() for future in futures]
+
+
+def write_results(results, csv_path):
+    with open(csv_path, "w", newline="") as csv_file:
+        writer = csv.DictWriter(csv_file, fieldnames=list(results[0]))
+        writer.writeheader()
+        writer.writerows(results)
+
+    print(
+        "{:>18} {:>6} {:>6} {:>9} {:>9} {:>10} {:>11}".format(
+            "model", "batch", "epochs", "optimizer", "accuracy", "train [s]", "latency [ms]"
+        )
+    )
+    for result in sorted(results, key=lambda result: -result["test_accuracy"]):
+        print(
+            "{model:>18} {batch_size:>6} {epochs:>6} {optimizer:>9} {test_accuracy:>9.3f} {training_time_s:>10.1f} "
+            "{latency_ms:>11.2f}".format(**result)
+        )
+
+
+if __name__ == "__main__":
+
+    grid = {
+        "model": ["base", "batch_norm", "larger_base_model", "separable", "separable_0.5"],
+        "batch_size": [16, 64],
+        "epochs": [10],
+        "optimizer": ["adam", "adadelta"],
+    }
+    num_parallel_trials = 2
+    threads_per_trial = max(1, os.cpu_count() // num_parallel_trials)
+    sweep_dir = os.path.join(model_cfg.FEATURE_CACHE_PATH, "sweep")
+
+    array_paths = export_features(
+        sweep_dir,
+        test_size=0.1,
+        random_state=1,
+        max_samples=2500,
+        is_using_mfcc=True,
+        num_workers=os.cpu_count(),
+        cache_dir=model_cfg.FEATURE_CACHE_PATH,
+        dtype_policy="compact",
+        manifest_path=model_cfg.AUDIO_MANIFEST_PATH,
+        is_balanced=True,
+    )
+    results = run_sweep(array_paths, grid, num_parallel_trials, threads_per_trial)
+    write_results(results, os.path.join(model_cfg.MODEL_PATH, "saved_models/sweep_results.csv"))
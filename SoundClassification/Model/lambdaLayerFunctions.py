@@ -1,31 +1,115 @@
-import numpy as np 
+import inspect
+
+import librosa
+import numpy as np
+import scipy.fftpack
 import tensorflow as tf
 
 
-def mfcc_layer(X):
+class MfccLayer(tf.keras.layers.Layer):
     """
-    This method is used as the first layer of the neural network. By doing so the network is able to do the
-    mfcc transform on it own.
+    This layer is used as the first layer of the neural network. By doing so the network is able to do the mfcc
+    transform on its own, in training and on the phone, from the raw wave signal.
 
-    Arguments:
-        X {tf.Tensor} -- raw data from the wav file
+    It computes the same features as load_data.convert_data_to_mfcc (librosa.feature.mfcc) with TensorFlow operations:
+    centered STFT with a periodic hann window, power spectrogram, librosa mel filter bank (a constant of the graph),
+    conversion to decibels limited to top_db below the maximum of each sample, and an orthonormal DCT-II computed as a
+    matrix product. The mfcc are then zero-padded to a max_pad_len x max_pad_len image.
 
-    Returns:
-        np.array -- Array that contains the mfcc transformed data
+    The STFT needs the select TensorFlow ops of TFLite on the TensorFlow versions whose TFLite has no builtin FFT, see
+    tflite_utils.convert_keras_model. The FFT of TFLite only supports power of two lengths, so a layer whose n_fft is
+    not one, e.g. 682 at 16 000 Hz, can be trained but not converted.
     """
-    ## Convert the TensorFlow tensor to np.array
-    X_np = tf.make_ndarray(tf.make_tensor_proto(X))
-    print(X_np.shape)
 
-    X = tf.convert_to_tensor(X_np)
-    print(X.get_shape())
-    return X
+    def __init__(
+        self,
+        sample_rate=48000,
+        n_mfcc=20,
+        n_fft=2048,
+        hop_length=512,
+        n_mels=128,
+        top_db=80.0,
+        max_pad_len=256,
+        pad_mode=None,
+        **kwargs
+    ):
+        """
+        Keyword Arguments:
+            sample_rate {int} -- Sample rate of the input signal (default: {48000})
+            n_mfcc {int} -- Number of mfcc coefficients (default: {20})
+            n_fft {int} -- Length of the FFT windows (default: {2048})
+            hop_length {int} -- Number of samples between two successive frames (default: {512})
+            n_mels {int} -- Number of mel bands (default: {128})
+            top_db {float} -- Dynamic range of the decibels (default: {80.0})
+            max_pad_len {int} -- Padding length, or None to keep the (n_mfcc, frames) shape (default: {256})
+            pad_mode {str} -- Padding of the centered frames, "reflect" or "constant" (default: {None}, the default
+                of librosa.stft, which is "reflect" before librosa 0.10 and "constant" since)
+        """
+        super().__init__(**kwargs)
+        self.sample_rate = sample_rate
+        self.n_mfcc = n_mfcc
+        self.n_fft = n_fft
+        self.hop_length = hop_length
+        self.n_mels = n_mels
+        self.top_db = top_db
+        self.max_pad_len = max_pad_len
+        self.pad_mode = pad_mode or inspect.signature(librosa.stft).parameters["pad_mode"].default
+
+        mel_basis = librosa.filters.mel(sr=sample_rate, n_fft=n_fft, n_mels=n_mels)
+        dct_basis = scipy.fftpack.dct(np.eye(n_mels), type=2, norm="ortho", axis=0)[:n_mfcc]
+        # Transposed so that they multiply the (frames, frequencies) spectrograms from the right
+        self.mel_basis = tf.constant(mel_basis.T, dtype=tf.float32)
+        self.dct_basis = tf.constant(dct_basis.T, dtype=tf.float32)
+
+    def get_num_frames(self, signal_length):
+        return 1 + signal_length // self.hop_length
+
+    def call(self, inputs):
+        # Every sample is a 1d signal, whether it is given as (length,), (length, 1) or (1, length, 1)
+        signals = tf.reshape(tf.cast(inputs, tf.float32), [tf.shape(inputs)[0], -1])
+        signals = tf.pad(signals, [[0, 0], [self.n_fft // 2, self.n_fft // 2]], mode=self.pad_mode.upper())
+
+        stft = tf.signal.stft(
+            signals,
+            frame_length=self.n_fft,
+            frame_step=self.hop_length,
+            fft_length=self.n_fft,
+            window_fn=tf.signal.hann_window,
+        )
+        power = tf.square(tf.abs(stft))
+        mel = tf.tensordot(power, self.mel_basis, axes=1)
+
+        decibels = 10.0 * tf.math.log(tf.maximum(mel, 1e-10)) / np.log(10.0)
+        decibels = tf.maximum(decibels, tf.reduce_max(decibels, axis=[1, 2], keepdims=True) - self.top_db)
+
+        mfcc = tf.transpose(tf.tensordot(decibels, self.dct_basis, axes=1), [0, 2, 1])
+        if self.max_pad_len is not None:
+            num_frames = mfcc.shape[2] if mfcc.shape[2] is not None else tf.shape(mfcc)[2]
+            mfcc = tf.pad(mfcc, [[0, 0], [0, self.max_pad_len - self.n_mfcc], [0, self.max_pad_len - num_frames]])
+        return tf.expand_dims(mfcc, -1)
 
+    def compute_output_shape(self, input_shape):
+        if self.max_pad_len is not None:
+            return (input_shape[0], self.max_pad_len, self.max_pad_len, 1)
+        signal_length = int(np.prod(input_shape[1:]))
+        return (input_shape[0], self.n_mfcc, self.get_num_frames(signal_length), 1)
 
-def mfcc_layer_output_shape(X):
-    print(X)
-    return (50, 256, 256, 1)
+    def get_config(self):
+        config = super().get_config()
+        config.update(
+            {
+                "sample_rate": self.sample_rate,
+                "n_mfcc": self.n_mfcc,
+                "n_fft": self.n_fft,
+                "hop_length": self.hop_length,
+                "n_mels": self.n_mels,
+                "top_db": self.top_db,
+                "max_pad_len": self.max_pad_len,
+                "pad_mode": self.pad_mode,
+            }
+        )
+        return config
 
 
-def some_function(X):
-    return X.numpy()
+# Layers which are not part of Keras, to give to tf.keras.models.load_model
+CUSTOM_OBJECTS = {"MfccLayer": MfccLayer}
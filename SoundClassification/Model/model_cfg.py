@@ -2,4 +2,8 @@ import os
 from SoundClassification import cfg
 
 AUDIOSET_PATH = os.path.join(cfg.DATA_PATH, "AudioSet/audio")
+AUDIO_MANIFEST_PATH = os.path.join(cfg.DATA_PATH, "AudioSet/audio_manifest.json")
+FEATURE_CACHE_PATH = os.path.join(cfg.DATA_PATH, "AudioSet/feature_cache")
+TRAINING_SHARDS_PATH = os.path.join(cfg.DATA_PATH, "AudioSet/training_shards")
 MODEL_PATH = os.path.join(cfg.PROJECT_PATH, "Model")
+CHECKPOINT_PATH = os.path.join(MODEL_PATH, "saved_models/checkpoints")
@@ -1,5 +1,11 @@
+import os
+
 import BaseModel
+import model_cfg
+import models
 from SoundClassification.DataProcessing import load_data
+from SoundClassification.DataProcessing import shards
+from SoundClassification.DataProcessing import streaming
 
 
 if __name__ == "__main__":
@@ -13,30 +19,112 @@ if __name__ == "__main__":
     # model_name = "batch_norm"
     model_name = "larger_base_model"
     # model_name = "base"
+    # Computes the mfcc of the raw windows in the graph, is_using_mfcc is then ignored. Its TFLite export needs a
+    # power of two n_fft, i.e. a sample_rate of 48000 or 24000 but not 16000 (see tflite_utils.convert_keras_model).
     # model_name = "lambda_base"
+    # model_name = "separable"  # or "separable_0.5", "separable_0.25", see models.separable_model
     max_samples = 2500
     is_exporting_to_tf_lite = True
+    tflite_quantization = "float32"  # or "dynamic", "float16", "int8", see tflite_utils.QUANTIZATIONS
+    is_reporting_quantizations = False  # compare the accuracy, size and latency of every quantization
     is_using_mfcc = True
+    num_workers = os.cpu_count()  # processes extracting the features
+    cache_dir = model_cfg.FEATURE_CACHE_PATH  # set to None to disable the on-disk feature cache
+    manifest_path = model_cfg.AUDIO_MANIFEST_PATH  # index of the audio files, set to None to list the folders
+    is_balanced = True  # sample exactly max_samples windows per label from the files in a seeded random order
+    # Keyword arguments of BaseModel.set_performance_profile, e.g. {"intra_op_threads": os.cpu_count(),
+    # "inter_op_threads": 1, "jit_compile": True}. benchmark_training.py compares the profiles on the current host.
+    performance_profile = {}
+    is_checkpointing = True  # resumable checkpoints, set to False to only save the best model
+    checkpoint_every = 5  # epochs between two resumable checkpoints
+    is_resuming = False  # resume an interrupted training from the latest checkpoint of its configuration, if any
+    dtype_policy = "compact"  # int16 cached raw windows and float32 mfcc windows, see load_data.DTYPE_POLICIES
+    is_streaming = False  # decode the files lazily with tf.data instead of loading the whole dataset in memory
+    sample_rate = 48000  # working sample rate, e.g. 16000 to resample the recordings once when they are decoded
+    max_pad_len = 256  # None for the native (n_mfcc, frames) mfcc, see compare_feature_layouts.py
+    feature_params = dict(load_data.DEFAULT_FEATURE_PARAMS, sample_rate=sample_rate, max_pad_len=max_pad_len)
+    # Folder written by export_training_shards.py, e.g. model_cfg.TRAINING_SHARDS_PATH, to train from the exported
+    # windows instead of the audio files. The feature parameters are then those of its manifest.
+    shard_dir = None
+
+    # The thread pools must be set before the streaming and shard datasets start the TensorFlow runtime
+    BaseModel.set_thread_pools(performance_profile.get("intra_op_threads"), performance_profile.get("inter_op_threads"))
+    # Batch size of the datasets: the one set_performance_profile gives to the model, whose learning rate is scaled by
+    # the same multiplier
+    batch_size = num_batch_size * performance_profile.get("batch_size_multiplier", 1)
+
+    if shard_dir is not None:
+        manifest = shards.load_manifest(shard_dir)
+        is_using_mfcc = manifest["representation"] == "mfcc"
+        feature_params = manifest["feature_params"]
+
+    model_params = {}
+    if model_name in models.RAW_INPUT_MODELS:
+        is_using_mfcc = False
+        model_params = dict(load_data.get_mfcc_params(feature_params), sample_rate=feature_params["sample_rate"])
 
     if is_using_mfcc:
-        num_rows = 256
-        num_columns = 256
+        num_rows, num_columns, _ = load_data.get_sample_shape(is_using_mfcc, feature_params)
     else:
-        num_rows = 1
-        num_columns = 96000
+        # (window_length, 1) windows of raw samples
+        num_rows, num_columns = load_data.get_sample_shape(is_using_mfcc, feature_params)
 
-    X_train, X_test, y_train, y_test = load_data.get_train_test_data(
-        test_size=test_size, random_state=random_seed, max_samples=max_samples, is_using_mfcc=is_using_mfcc
-    )
+    checkpoint_dir = None
+    if is_checkpointing:
+        # One folder per configuration, so that a training never resumes from the checkpoint of another model
+        checkpoint_dir = os.path.join(
+            model_cfg.CHECKPOINT_PATH, "{}_{}x{}_{}".format(model_name, num_rows, num_columns, batch_size)
+        )
+
+    if shard_dir is not None:
+        X_train, X_test = shards.get_train_test_datasets(shard_dir, batch_size=batch_size, random_state=random_seed)
+        y_train, y_test = None, None
+    elif is_streaming:
+        X_train, X_test = streaming.get_train_test_datasets(
+            test_size=test_size,
+            random_state=random_seed,
+            max_samples=max_samples,
+            is_using_mfcc=is_using_mfcc,
+            batch_size=batch_size,
+            feature_params=feature_params,
+            manifest_path=manifest_path,
+        )
+        y_train, y_test = None, None
+    else:
+        X_train, X_test, y_train, y_test = load_data.get_train_test_data(
+            test_size=test_size,
+            random_state=random_seed,
+            max_samples=max_samples,
+            is_using_mfcc=is_using_mfcc,
+            num_workers=num_workers,
+            feature_params=feature_params,
+            cache_dir=cache_dir,
+            dtype_policy=dtype_policy,
+            manifest_path=manifest_path,
+            is_balanced=is_balanced,
+        )
 
     base_model = BaseModel.BaseModel(
         num_rows, num_columns, num_channels, num_labels, num_batch_size=num_batch_size, num_epochs=num_epochs
     )
-    base_model.define_model(model=model_name)
+    base_model.set_performance_profile(**performance_profile)
+    base_model.define_model(model=model_name, **model_params)
     base_model.define_loss_and_optimizer()
-    base_model.train_model(X_train, y_train, X_test, y_test)
+    base_model.train_model(
+        X_train,
+        y_train,
+        X_test,
+        y_test,
+        checkpoint_dir=checkpoint_dir,
+        checkpoint_every=checkpoint_every,
+        resume=is_resuming,
+        random_state=random_seed,
+    )
 
     if is_exporting_to_tf_lite:
-        base_model.export_model_to_tf_lite()
+        # The int8 calibration windows are drawn from the (cached) training features
+        base_model.export_model_to_tf_lite(quantization=tflite_quantization, representative_data=X_train)
+        if is_reporting_quantizations:
+            base_model.report_tf_lite_quantizations(X_train, X_test, y_test)
     else:
         base_model.export_model(model_name=model_name)
@@ -1,31 +1,52 @@
+from functools import partial
 
 from tensorflow.keras.models import Sequential
 from tensorflow.keras.layers import Dense, Dropout
 from tensorflow.keras.layers import Conv2D, MaxPooling2D, GlobalAveragePooling2D, Flatten
+from tensorflow.keras.layers import DepthwiseConv2D
 from tensorflow.keras.layers import BatchNormalization
 from tensorflow.keras.layers import Activation
 
-from tensorflow.keras.layers import Lambda
-
 import lambdaLayerFunctions
 
 
+def get_conv_padding(num_rows, num_columns, num_blocks=4):
+    """
+    Returns the padding of a stack of num_blocks kernel 2 convolutions each followed by a 2x2 max-pooling: "valid",
+    like the original models, when the input is large enough, e.g. the 256x256 padded mfcc, and "same" for the smaller
+    inputs, e.g. the native (n_mfcc, frames) mfcc, which the "valid" convolutions would shrink to nothing.
+    """
+    size = min(num_rows, num_columns)
+    for _ in range(num_blocks):
+        size = (size - 1) // 2
+    return 'valid' if size >= 1 else 'same'
+
+
 def base_model(num_rows, num_columns, num_channels, num_labels):
 
+    padding = get_conv_padding(num_rows, num_columns)
     model = Sequential()
-    model.add(Conv2D(filters=16, kernel_size=2, input_shape=(num_rows, num_columns, num_channels), activation='relu'))
+    model.add(
+        Conv2D(
+            filters=16,
+            kernel_size=2,
+            padding=padding,
+            input_shape=(num_rows, num_columns, num_channels),
+            activation='relu',
+        )
+    )
     model.add(MaxPooling2D(pool_size=2))
     model.add(Dropout(0.2))
 
-    model.add(Conv2D(filters=32, kernel_size=2, activation='relu'))
+    model.add(Conv2D(filters=32, kernel_size=2, padding=padding, activation='relu'))
     model.add(MaxPooling2D(pool_size=2))
     model.add(Dropout(0.2))
 
-    model.add(Conv2D(filters=64, kernel_size=2, activation='relu'))
+    model.add(Conv2D(filters=64, kernel_size=2, padding=padding, activation='relu'))
     model.add(MaxPooling2D(pool_size=2))
     model.add(Dropout(0.2))
 
-    model.add(Conv2D(filters=128, kernel_size=2, activation='relu'))
+    model.add(Conv2D(filters=128, kernel_size=2, padding=padding, activation='relu'))
     model.add(MaxPooling2D(pool_size=2))
     model.add(Dropout(0.2))
 
@@ -36,25 +57,35 @@ def base_model(num_rows, num_columns, num_channels, num_labels):
     return model
 
 
-def base_lambda_model(num_rows, num_columns, num_channels, num_labels):
+def base_lambda_model(num_rows, num_columns, num_channels, num_labels, **mfcc_params):
+    """
+    base_model computing its own mfcc from the raw wave signal, as returned by load_data.get_train_test_data with
+    is_using_mfcc=False: num_rows is the window length and num_columns the number of audio channels (1). num_channels
+    is the number of channels of the mfcc image (1).
 
+    Keyword Arguments:
+        mfcc_params -- Keyword arguments of lambdaLayerFunctions.MfccLayer, e.g. the sample_rate and the n_fft and
+            hop_length of load_data.get_mfcc_params (default: those of load_data.DEFAULT_FEATURE_PARAMS)
+    """
     model = Sequential()
 
-    model.add(Lambda(lambdaLayerFunctions.mfcc_layer, input_shape=(num_rows, num_columns, num_channels)))
+    mfcc_layer = lambdaLayerFunctions.MfccLayer(input_shape=(num_rows, num_columns), **mfcc_params)
+    padding = get_conv_padding(*mfcc_layer.compute_output_shape((None, num_rows, num_columns))[1:3])
+    model.add(mfcc_layer)
 
-    model.add(Conv2D(filters=16, kernel_size=2, activation='relu'))
+    model.add(Conv2D(filters=16, kernel_size=2, padding=padding, activation='relu'))
     model.add(MaxPooling2D(pool_size=2))
     model.add(Dropout(0.2))
 
-    model.add(Conv2D(filters=32, kernel_size=2, activation='relu'))
+    model.add(Conv2D(filters=32, kernel_size=2, padding=padding, activation='relu'))
     model.add(MaxPooling2D(pool_size=2))
     model.add(Dropout(0.2))
 
-    model.add(Conv2D(filters=64, kernel_size=2, activation='relu'))
+    model.add(Conv2D(filters=64, kernel_size=2, padding=padding, activation='relu'))
     model.add(MaxPooling2D(pool_size=2))
     model.add(Dropout(0.2))
 
-    model.add(Conv2D(filters=128, kernel_size=2, activation='relu'))
+    model.add(Conv2D(filters=128, kernel_size=2, padding=padding, activation='relu'))
     model.add(MaxPooling2D(pool_size=2))
     model.add(Dropout(0.2))
 
@@ -67,20 +98,29 @@ def base_lambda_model(num_rows, num_columns, num_channels, num_labels):
 
 def larger_base_model(num_rows, num_columns, num_channels, num_labels):
 
+    padding = get_conv_padding(num_rows, num_columns)
     model = Sequential()
-    model.add(Conv2D(filters=32, kernel_size=2, input_shape=(num_rows, num_columns, num_channels), activation='relu'))
+    model.add(
+        Conv2D(
+            filters=32,
+            kernel_size=2,
+            padding=padding,
+            input_shape=(num_rows, num_columns, num_channels),
+            activation='relu',
+        )
+    )
     model.add(MaxPooling2D(pool_size=2))
     model.add(Dropout(0.2))
 
-    model.add(Conv2D(filters=64, kernel_size=2, activation='relu'))
+    model.add(Conv2D(filters=64, kernel_size=2, padding=padding, activation='relu'))
     model.add(MaxPooling2D(pool_size=2))
     model.add(Dropout(0.2))
 
-    model.add(Conv2D(filters=128, kernel_size=2, activation='relu'))
+    model.add(Conv2D(filters=128, kernel_size=2, padding=padding, activation='relu'))
     model.add(MaxPooling2D(pool_size=2))
     model.add(Dropout(0.2))
 
-    model.add(Conv2D(filters=256, kernel_size=2, activation='relu'))
+    model.add(Conv2D(filters=256, kernel_size=2, padding=padding, activation='relu'))
     model.add(MaxPooling2D(pool_size=2))
     model.add(Dropout(0.2))
 
@@ -123,3 +163,69 @@ def batch_norm_model(num_rows, num_columns, num_channels, num_labels):
     model.add(Dense(num_labels, activation='softmax'))
 
     return model
+
+
+def scale_filters(filters, width_multiplier):
+    # Multiple of 8, which the CPU kernels vectorise best
+    return max(8, int(round(filters * width_multiplier / 8)) * 8)
+
+
+def separable_model(num_rows, num_columns, num_channels, num_labels, width_multiplier=1.0):
+    """
+    Small-footprint architecture for the phones, built like MobileNet from depthwise-separable convolutions: every
+    block filters each channel on its own (DepthwiseConv2D) and then mixes the channels (1x1 Conv2D), which costs about
+    8 times fewer operations than a 3x3 Conv2D. The strided convolutions replace the max-poolings.
+
+    The budget of the family, as measured by profile_models.py on a 256x256 input with the TFLite interpreter on one
+    CPU thread, is 0.5 ms of latency and 256 kB of .tflite file at width_multiplier 1 (about 5 times fewer operations
+    than base_model and 20 times fewer than larger_base_model), and 0.25 ms and 64 kB at width_multiplier 0.5.
+
+    Keyword Arguments:
+        width_multiplier {float} -- Factor applied to the number of filters of every layer, trading accuracy for
+            latency and size (default: {1.0})
+    """
+    model = Sequential()
+
+    model.add(
+        Conv2D(
+            scale_filters(16, width_multiplier),
+            kernel_size=3,
+            strides=2,
+            padding='same',
+            use_bias=False,
+            input_shape=(num_rows, num_columns, num_channels),
+        )
+    )
+    model.add(BatchNormalization())
+    model.add(Activation('relu'))
+
+    for filters, strides in [(32, 2), (64, 2), (64, 1), (128, 2), (128, 1), (128, 2)]:
+        model.add(DepthwiseConv2D(kernel_size=3, strides=strides, padding='same', use_bias=False))
+        model.add(BatchNormalization())
+        model.add(Activation('relu'))
+
+        model.add(Conv2D(scale_filters(filters, width_multiplier), kernel_size=1, use_bias=False))
+        model.add(BatchNormalization())
+        model.add(Activation('relu'))
+
+    model.add(GlobalAveragePooling2D())
+    model.add(Dropout(0.2))
+
+    model.add(Dense(num_labels, activation='softmax'))
+
+    return model
+
+
+# Architectures selected by name in BaseModel.define_model, with the optimizer they are compiled with by default
+MODELS = {
+    "base": base_model,
+    "lambda_base": base_lambda_model,
+    "batch_norm": batch_norm_model,
+    "larger_base_model": larger_base_model,
+    "separable": separable_model,
+    "separable_0.5": partial(separable_model, width_multiplier=0.5),
+    "separable_0.25": partial(separable_model, width_multiplier=0.25),
+}
+DEFAULT_OPTIMIZERS = {"batch_norm": "adadelta"}
+# Architectures taking the raw wave signal instead of the mfcc
+RAW_INPUT_MODELS = {"lambda_base"}
@@ -0,0 +1,220 @@
+"""
+Profiles the inference cost of every architecture of models.MODELS: number of parameters, FLOPs per inference,
+activation memory, CPU latency of the Keras model (one sample and a batch of 32) and of its TFLite conversion, and the
+size of the .tflite file. The script is run like model_training.py (with the PYTHONPATH set by setup_script.sh):
+
+    python SoundClassification/Model/profile_models.py [model_name ...]
+
+and writes the profiles to saved_models/model_profiles.json, so that they can be compared when an architecture changes.
+The models are not trained: the costs only depend on the architecture and on the input shape. A model which is killed
+while being profiled, e.g. because its TFLite conversion does not fit in memory, is reported with an error.
+"""
+import json
+import os
+import subprocess
+import sys
+
+os.environ["CUDA_VISIBLE_DEVICES"] = "-1"  # the phones run the models on CPU
+
+import numpy as np
+import tensorflow as tf
+
+import lambdaLayerFunctions
+import model_cfg
+import models
+import tflite_utils
+from SoundClassification.DataProcessing import load_data
+
+BYTES_PER_VALUE = 4  # float32
+
+
+def get_layer_flops(layer):
+    """
+    Returns the number of floating point operations of a layer for one sample, counting a multiply-add as two
+    operations. Only the convolutions, the dense layers and the in-graph MFCC of MfccLayer are counted: the pooling
+    layers and the activations are negligible and the batch normalisations are folded into the previous layer by the
+    TFLite converter.
+    """
+    input_shape = layer.input.shape
+    output_shape = layer.output.shape
+    if isinstance(layer, lambdaLayerFunctions.MfccLayer):
+        return get_mfcc_flops(layer, int(np.prod(input_shape[1:])))
+    if isinstance(layer, tf.keras.layers.Dense):
+        return 2 * int(input_shape[-1]) * int(output_shape[-1])
+    if isinstance(layer, tf.keras.layers.SeparableConv2D):
+        kernel_height, kernel_width = layer.kernel_size
+        output_pixels = int(output_shape[1]) * int(output_shape[2])
+        depthwise_channels = int(input_shape[-1]) * layer.depth_multiplier
+        # The depthwise convolution has the strides, the pointwise convolution runs on its output
+        depthwise = kernel_height * kernel_width * depthwise_channels * output_pixels
+        pointwise = depthwise_channels * int(output_shape[-1]) * output_pixels
+        return 2 * (depthwise + pointwise)
+    if isinstance(layer, tf.keras.layers.DepthwiseConv2D):
+        kernel_height, kernel_width = layer.kernel_size
+        output_pixels = int(output_shape[1]) * int(output_shape[2])
+        return 2 * kernel_height * kernel_width * int(output_shape[-1]) * output_pixels
+    if isinstance(layer, tf.keras.layers.Conv2D):
+        kernel_height, kernel_width = layer.kernel_size
+        output_pixels = int(output_shape[1]) * int(output_shape[2])
+        return 2 * kernel_height * kernel_width * int(input_shape[-1]) * int(output_shape[-1]) * output_pixels
+    return 0
+
+
+def get_mfcc_flops(layer, signal_length):
+    """
+    Returns an estimate of the number of floating point operations of the MFCC computed by a MfccLayer for a signal of
+    signal_length samples. Every frame is windowed, transformed by a real FFT (about 2.5 * n_fft * log2(n_fft)
+    operations), squared into a power spectrum, multiplied by the mel filter bank, converted to decibels and multiplied
+    by the DCT basis.
+    """
+    num_frames = layer.get_num_frames(signal_length)
+    num_frequencies = layer.n_fft // 2 + 1
+    window = layer.n_fft
+    fft = 2.5 * layer.n_fft * np.log2(layer.n_fft)
+    power = 3 * num_frequencies
+    mel = 2 * num_frequencies * layer.n_mels
+    decibels = 3 * layer.n_mels  # the logarithm, its scaling and the top_db clipping
+    dct = 2 * layer.n_mels * layer.n_mfcc
+    return int(num_frames * (window + fft + power + mel + decibels + dct))
+
+
+def get_model_flops(model):
+    """
+    Returns the number of floating point operations of a model for one sample, see get_layer_flops.
+    """
+    return int(sum(get_layer_flops(layer) for layer in model.layers))
+
+
+def get_activation_memory(model):
+    """
+    Returns the memory in bytes of the outputs of all the layers for one sample, and the peak memory of the
+    activations when only the input and the output of the running layer are kept, as an interpreter reusing its
+    buffers does for a sequential model.
+    """
+    input_size = int(np.prod(model.layers[0].input.shape[1:]))
+    total = 0
+    peak = 0
+    for layer in model.layers:
+        output_size = int(np.prod(layer.output.shape[1:]))
+        total += output_size
+        peak = max(peak, input_size + output_size)
+        input_size = output_size
+    return BYTES_PER_VALUE * total, BYTES_PER_VALUE * peak
+
+
+def measure_keras_latency(model, X, num_warmup_runs=5, num_runs=50):
+    """
+    Returns the median latency in milliseconds of a forward pass of the Keras model on the batch X.
+    """
+    X = tf.convert_to_tensor(X, dtype=tf.float32)
+    latencies = tflite_utils.measure_latencies(lambda: model(X, training=False), num_warmup_runs, num_runs)
+    return float(np.median(latencies))
+
+
+def profile_model(model, sample_shape, num_runs=50, batch_size=32):
+    """
+    Returns the cost profile of a Keras model taking samples of sample_shape as a dictionary.
+    """
+    X = np.random.RandomState(0).randn(batch_size, *sample_shape).astype(np.float32)
+    # The latencies are measured first since Keras only defines the shapes of the layers once the model has been called
+    keras_latency = measure_keras_latency(model, X[:1], num_runs=num_runs)
+    keras_batch_latency = measure_keras_latency(model, X, num_runs=max(1, num_runs // 5))
+    tflite_model = tflite_utils.convert_keras_model(model)
+    activation_bytes, peak_activation_bytes = get_activation_memory(model)
+    return {
+        "input_shape": list(sample_shape),
+        "num_params": int(model.count_params()),
+        "flops": get_model_flops(model),
+        "activation_bytes": activation_bytes,
+        "peak_activation_bytes": peak_activation_bytes,
+        "keras_latency_ms": keras_latency,
+        "keras_batch_latency_ms": keras_batch_latency,
+        "keras_batch_size": batch_size,
+        "tflite_latency_ms": tflite_utils.measure_interpreter_latency(
+            tflite_utils.make_interpreter(tflite_model), num_runs=num_runs
+        ),
+        "tflite_bytes": len(tflite_model),
+    }
+
+
+def run_profile(model_name, feature_params, num_labels, num_runs=50):
+    """
+    Profiles one architecture of models.MODELS on the samples of feature_params and prints its profile as a JSON line.
+    """
+    if model_name in models.RAW_INPUT_MODELS:
+        sample_shape = load_data.get_sample_shape(False, feature_params)
+        mfcc_params = dict(load_data.get_mfcc_params(feature_params), sample_rate=feature_params["sample_rate"])
+        model = models.MODELS[model_name](*sample_shape, 1, num_labels, **mfcc_params)
+    else:
+        sample_shape = load_data.get_sample_shape(True, feature_params)
+        model = models.MODELS[model_name](*sample_shape, num_labels)
+    print(json.dumps(profile_model(model, sample_shape, num_runs=num_runs)))
+
+
+def profile_models(model_names, feature_params, num_labels, num_runs=50):
+    """
+    Profiles every architecture of model_names, each in its own process so that the memory of a model (or a model
+    which does not fit in memory) does not affect the others, and returns their profiles by name. An architecture which
+    cannot be built or converted gets an "error" entry instead of stopping the profiling of the others.
+    """
+    profiles = {}
+    for model_name in model_names:
+        print("Profiling", model_name)
+        arguments = json.dumps([model_name, feature_params, num_labels, num_runs])
+        process = subprocess.run(
+            [sys.executable, __file__, "--single", arguments],
+            stdout=subprocess.PIPE,
+            stderr=subprocess.PIPE,
+            universal_newlines=True,
+        )
+        if process.returncode == 0:
+            profiles[model_name] = json.loads(process.stdout.strip().splitlines()[-1])
+        elif process.returncode < 0:
+            profiles[model_name] = {"error": "killed by signal {}, e.g. out of memory".format(-process.returncode)}
+        else:
+            profiles[model_name] = {"error": process.stderr.strip().splitlines()[-1]}
+    return profiles
+
+
+def print_profiles(profiles):
+    print(
+        "{:>18} {:>10} {:>8} {:>11} {:>10} {:>14} {:>11} {:>11}".format(
+            "model", "params", "MFLOPs", "peak [MB]", "keras [ms]", "keras x32 [ms]", "tflite [ms]", "tflite [kB]"
+        )
+    )
+    for model_name, profile in profiles.items():
+        if "error" in profile:
+            print("{:>18} {}".format(model_name, profile["error"]))
+            continue
+        print(
+            "{:>18} {:>10} {:>8.1f} {:>11.2f} {:>10.2f} {:>14.2f} {:>11.2f} {:>11.1f}".format(
+                model_name,
+                profile["num_params"],
+                profile["flops"] / 1e6,
+                profile["peak_activation_bytes"] / 1024 ** 2,
+                profile["keras_latency_ms"],
+                profile["keras_batch_latency_ms"],
+                profile["tflite_latency_ms"],
+                profile["tflite_bytes"] / 1024,
+            )
+        )
+
+
+if __name__ == "__main__":
+
+    if sys.argv[1:2] == ["--single"]:
+        # Child process of profile_models
+        run_profile(*json.loads(sys.argv[2]))
+        sys.exit()
+
+    model_names = sys.argv[1:] or list(models.MODELS)
+    num_labels = 3
+    feature_params = load_data.DEFAULT_FEATURE_PARAMS
+    output_path = os.path.join(model_cfg.MODEL_PATH, "saved_models/model_profiles.json")
+
+    profiles = profile_models(model_names, feature_params, num_labels)
+    print_profiles(profiles)
+    with open(output_path, "w") as json_file:
+        json.dump(
+            {"tensorflow_version": tf.__version__, "num_labels": num_labels, "models": profiles}, json_file, indent=4
+        )
@@ -0,0 +1,200 @@
+"""
+Structured pruning of the trained model (saved_models/best_model.hdf5): the filters of the convolutions and the units
+of the hidden dense layers with the smallest L1 norm are removed, the model is fine-tuned for a few epochs and exported
+to TFLite. The pruned models are dense, i.e. physically smaller and faster, unlike the sparse models of weight pruning.
+The script is run like model_training.py (with the PYTHONPATH set by setup_script.sh):
+
+    python SoundClassification/Model/pruning.py
+
+It prunes the model at several sparsities (or to a FLOP budget) and writes the pruned models to saved_models/pruned and
+their size, latency and accuracy to saved_models/pruning_report.json. Like profile_models.py, it runs on CPU.
+"""
+import json
+import os
+
+import numpy as np
+import tensorflow as tf
+
+import lambdaLayerFunctions
+import model_cfg
+import profile_models
+import tflite_utils
+from SoundClassification.DataProcessing import load_data
+
+
+def take(array, indices, axis):
+    return array if indices is None else np.take(array, indices, axis=axis)
+
+
+def get_kept_filters(kernel, num_kept):
+    """
+    Returns the sorted indices of the num_kept output filters (last axis of the kernel) with the largest L1 norm.
+    """
+    norms = np.abs(kernel).reshape(-1, kernel.shape[-1]).sum(axis=0)
+    return np.sort(np.argsort(-norms, kind="stable")[:num_kept])
+
+
+def prune_model(model, sample_shape, sparsity):
+    """
+    Returns a copy of a Sequential model of models.py without the fraction sparsity of the filters of every
+    convolution and of the units of every hidden dense layer, those with the smallest L1 norm. The depthwise
+    convolutions and the batch normalisations keep the channels of the previous layer, and the output layer keeps all
+    its units. The pruned model is not compiled.
+
+    Arguments:
+        model {tf.keras.Sequential} -- Trained model
+        sample_shape {tuple} -- Shape of one input sample
+        sparsity {float} -- Fraction of the filters removed from every layer, in [0, 1)
+    """
+    model(np.zeros((1,) + tuple(sample_shape), dtype=np.float32))  # defines the shapes of the layers
+    pruned_model = tf.keras.Sequential()
+    pruned_model.add(tf.keras.Input(shape=sample_shape))
+    kept = None  # channels (or units) of the output of the previous layer which are kept, None for all of them
+
+    for layer in model.layers:
+        config = layer.get_config()
+        for key in ("batch_input_shape", "batch_shape", "input_shape"):
+            config.pop(key, None)
+        weights = layer.get_weights()
+
+        if isinstance(layer, tf.keras.layers.DepthwiseConv2D):
+            weights = [take(weights[0], kept, axis=2)] + [take(bias, kept, axis=0) for bias in weights[1:]]
+        elif isinstance(layer, tf.keras.layers.Conv2D):
+            kernel = take(weights[0], kept, axis=2)
+            kept = get_kept_filters(kernel, max(1, int(round(layer.filters * (1 - sparsity)))))
+            weights = [kernel[..., kept]] + [bias[kept] for bias in weights[1:]]
+            config["filters"] = len(kept)
+        elif isinstance(layer, tf.keras.layers.BatchNormalization):
+            weights = [take(weight, kept, axis=0) for weight in weights]
+        elif isinstance(layer, tf.keras.layers.Flatten) and kept is not None:
+            # The flattened features are ordered by row, column and then channel
+            height, width, channels = (int(dimension) for dimension in layer.input.shape[1:])
+            kept = (np.arange(height * width)[:, np.newaxis] * channels + kept[np.newaxis, :]).ravel()
+        elif isinstance(layer, tf.keras.layers.Dense):
+            kernel = take(weights[0], kept, axis=0)
+            if layer is model.layers[-1]:
+                kept = None
+            else:
+                kept = get_kept_filters(kernel, max(1, int(round(layer.units * (1 - sparsity)))))
+                config["units"] = len(kept)
+            weights = [take(kernel, kept, axis=1)] + [take(bias, kept, axis=0) for bias in weights[1:]]
+
+        pruned_layer = type(layer).from_config(config)
+        pruned_model.add(pruned_layer)
+        pruned_layer.set_weights(weights)
+    return pruned_model
+
+
+def find_sparsity(model, sample_shape, max_flops, step=0.05):
+    """
+    Returns the smallest multiple of step for which the pruned model needs at most max_flops per sample.
+    """
+    for sparsity in np.arange(0, 1, step):
+        if profile_models.get_model_flops(prune_model(model, sample_shape, sparsity)) <= max_flops:
+            return float(round(sparsity, 6))
+    raise ValueError("No sparsity below 1 prunes the model to {} FLOPs".format(max_flops))
+
+
+def fine_tune(model, X_train, y_train, num_epochs, batch_size=16, learning_rate=1e-4):
+    """
+    Compiles the pruned model and trains it for num_epochs, with a learning rate lower than the one of the training
+    so that the remaining weights are only adjusted.
+    """
+    model.compile(
+        loss="categorical_crossentropy",
+        optimizer=tf.keras.optimizers.Adam(learning_rate=learning_rate),
+        metrics=["accuracy"],
+    )
+    if num_epochs > 0:
+        model.fit(X_train, y_train, batch_size=batch_size, epochs=num_epochs, verbose=0)
+    return model
+
+
+def prune_and_report(model, X_train, y_train, X_test, y_test, sparsities, num_epochs, output_dir):
+    """
+    Prunes the model at every sparsity, fine-tunes it, saves it to output_dir as .hdf5 and .tflite files and returns
+    its size, FLOPs, latency and test accuracy before and after the fine-tuning.
+    """
+    os.makedirs(output_dir, exist_ok=True)
+    sample_shape = X_train.shape[1:]
+    results = []
+    for sparsity in sparsities:
+        print("Pruning {:.0%} of the filters".format(sparsity))
+        pruned_model = fine_tune(prune_model(model, sample_shape, sparsity), X_train, y_train, num_epochs=0)
+        _, pruned_accuracy = pruned_model.evaluate(X_test, y_test, verbose=0)
+        fine_tune(pruned_model, X_train, y_train, num_epochs)
+        _, test_accuracy = pruned_model.evaluate(X_test, y_test, verbose=0)
+
+        filename = os.path.join(output_dir, "pruned_{:02d}".format(int(round(100 * sparsity))))
+        pruned_model.save(filename + ".hdf5")
+        tflite_model = tflite_utils.convert_keras_model(pruned_model)
+        with open(filename + ".tflite", "wb") as tflite_file:
+            tflite_file.write(tflite_model)
+
+        results.append(
+            {
+                "sparsity": sparsity,
+                "num_params": int(pruned_model.count_params()),
+                "flops": profile_models.get_model_flops(pruned_model),
+                "tflite_bytes": len(tflite_model),
+                "tflite_latency_ms": tflite_utils.measure_interpreter_latency(
+                    tflite_utils.make_interpreter(tflite_model)
+                ),
+                "pruned_test_accuracy": float(pruned_accuracy),
+                "test_accuracy": float(test_accuracy),
+                "path": filename + ".tflite",
+            }
+        )
+    return results
+
+
+def print_report(results):
+    print(
+        "{:>8} {:>10} {:>8} {:>10} {:>12} {:>10} {:>10}".format(
+            "sparsity", "params", "MFLOPs", "size [kB]", "latency [ms]", "pruned", "fine-tuned"
+        )
+    )
+    for result in results:
+        print(
+            "{:>8.0%} {:>10} {:>8.1f} {:>10.1f} {:>12.2f} {:>10.3f} {:>10.3f}".format(
+                result["sparsity"],
+                result["num_params"],
+                result["flops"] / 1e6,
+                result["tflite_bytes"] / 1024,
+                result["tflite_latency_ms"],
+                result["pruned_test_accuracy"],
+                result["test_accuracy"],
+            )
+        )
+
+
+if __name__ == "__main__":
+
+    sparsities = [0, 0.25, 0.5, 0.75]  # 0 measures the model as trained, fine-tuned like the others
+    max_flops = None  # e.g. 50e6 to prune to the smallest sparsity within this budget instead
+    num_fine_tuning_epochs = 3
+    # Same data as model_training.py
+    feature_params = load_data.DEFAULT_FEATURE_PARAMS
+    model_path = os.path.join(model_cfg.MODEL_PATH, "saved_models/best_model.hdf5")
+    output_dir = os.path.join(model_cfg.MODEL_PATH, "saved_models/pruned")
+
+    X_train, X_test, y_train, y_test = load_data.get_train_test_data(
+        test_size=0.1,
+        random_state=1,
+        max_samples=2500,
+        is_using_mfcc=True,
+        num_workers=os.cpu_count(),
+        feature_params=feature_params,
+        cache_dir=model_cfg.FEATURE_CACHE_PATH,
+        dtype_policy="compact",
+        manifest_path=model_cfg.AUDIO_MANIFEST_PATH,
+        is_balanced=True,
+    )
+    model = tf.keras.models.load_model(model_path, custom_objects=lambdaLayerFunctions.CUSTOM_OBJECTS)
+    if max_flops is not None:
+        sparsities = [find_sparsity(model, X_train.shape[1:], max_flops)]
+
+    results = prune_and_report(model, X_train, y_train, X_test, y_test, sparsities, num_fine_tuning_epochs, output_dir)
+    print_report(results)
+    with open(os.path.join(model_cfg.MODEL_PATH, "saved_models/pruning_report.json"), "w") as json_file:
+        json.dump(results, json_file, indent=4)
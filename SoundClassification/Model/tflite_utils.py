@@ -0,0 +1,206 @@
+import time
+
+import numpy as np
+import tensorflow as tf
+
+import lambdaLayerFunctions
+
+
+# Post-training quantizations of convert_keras_model:
+# - float32: no quantization
+# - dynamic: int8 weights, dequantized on the fly, with the activations quantized dynamically by the kernels which can
+# - float16: float16 weights, about half the size of float32, computed in float32 on the CPU
+# - int8: int8 weights and activations, whose ranges are calibrated on a representative dataset. The input and the
+#   output stay float32 (quantized and dequantized by the model), as with the previous versions of the app.
+QUANTIZATIONS = ("float32", "dynamic", "float16", "int8")
+
+
+def convert_keras_model(
+    model, quantization="float32", representative_dataset=None, allow_select_tf_ops=None, saved_model_dir=None
+):
+    """
+    Converts a Keras model to a TFLite flatbuffer and returns its bytes. The models computing their own mfcc with an
+    n_fft which is not a power of two (e.g. 682 at 16 000 Hz) are refused, since the TFLite FFT cannot run them.
+
+    Keyword Arguments:
+        quantization {str} -- One of QUANTIZATIONS (default: {"float32"})
+        representative_dataset {callable} -- Calibration samples of the int8 quantization, see
+            get_representative_dataset (default: {None})
+        allow_select_tf_ops {bool} -- Whether the operations without a TFLite builtin, e.g. the FFT of
+            lambdaLayerFunctions.MfccLayer on older TensorFlow versions, run as TensorFlow ops. The app must then link
+            the TensorFlow ops library of TFLite (default: {None}, only for the models computing their own mfcc)
+        saved_model_dir {str} -- SavedModel of model to convert instead of the Keras model itself, with the same
+            quantization (default: {None})
+    """
+    if quantization not in QUANTIZATIONS:
+        raise ValueError("Unknown quantization {}, expected one of {}".format(quantization, QUANTIZATIONS))
+    if quantization == "int8" and representative_dataset is None:
+        raise ValueError("The int8 quantization needs a representative_dataset")
+    mfcc_layers = [layer for layer in model.layers if isinstance(layer, lambdaLayerFunctions.MfccLayer)]
+    for layer in mfcc_layers:
+        # The model would be converted but its FFT kernel fails on the first invocation
+        if layer.n_fft & (layer.n_fft - 1):
+            raise ValueError(
+                "The FFT of TFLite needs a power of two length but {} has n_fft={} at {} Hz. Use a sample rate at "
+                "which load_data.get_mfcc_params gives a power of two n_fft, e.g. 48000 or 24000 Hz".format(
+                    layer.name, layer.n_fft, layer.sample_rate
+                )
+            )
+    if allow_select_tf_ops is None:
+        allow_select_tf_ops = bool(mfcc_layers)
+
+    if saved_model_dir is not None:
+        converter = tf.lite.TFLiteConverter.from_saved_model(saved_model_dir)
+    else:
+        converter = tf.lite.TFLiteConverter.from_keras_model(model)
+    supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS]
+    if quantization != "float32":
+        converter.optimizations = [tf.lite.Optimize.DEFAULT]
+    if quantization == "float16":
+        converter.target_spec.supported_types = [tf.float16]
+    elif quantization == "int8":
+        converter.representative_dataset = representative_dataset
+        # Without select ops, the conversion fails on the operations which have no int8 kernel instead of silently
+        # running them in float32
+        supported_ops = [tf.lite.OpsSet.TFLITE_BUILTINS_INT8]
+    if allow_select_tf_ops:
+        # The builtins are still used for every operation which has one
+        supported_ops = supported_ops + [tf.lite.OpsSet.TFLITE_BUILTINS, tf.lite.OpsSet.SELECT_TF_OPS]
+    converter.target_spec.supported_ops = supported_ops
+    return converter.convert()
+
+
+def get_representative_dataset(X, num_samples=200, random_state=1):
+    """
+    Returns the representative_dataset of the int8 calibration: a function yielding num_samples windows drawn at
+    random from X, e.g. the cached training features.
+
+    Arguments:
+        X {np.array or tf.data.Dataset} -- Windows, or batches of (windows, labels) of which the first ones are used
+    """
+    if isinstance(X, tf.data.Dataset):
+        X = to_arrays(X, max_samples=num_samples)[0]
+    indices = np.random.RandomState(random_state).choice(len(X), min(num_samples, len(X)), replace=False)
+
+    def representative_dataset():
+        # In increasing order, which reads the memory-mapped features sequentially
+        for index in np.sort(indices):
+            yield [np.asarray(X[index : index + 1], dtype=np.float32)]
+
+    return representative_dataset
+
+
+def to_arrays(dataset, max_samples=None):
+    """
+    Returns the windows and the labels of a tf.data.Dataset of (windows, labels) batches as numpy arrays.
+    """
+    X_batches, y_batches = [], []
+    num_samples = 0
+    for X, y in dataset:
+        X_batches.append(X.numpy())
+        y_batches.append(y.numpy())
+        num_samples += len(X_batches[-1])
+        if max_samples is not None and num_samples >= max_samples:
+            break
+    return np.concatenate(X_batches), np.concatenate(y_batches)
+
+
+def make_interpreter(tflite_model, num_threads=1, batch_size=None):
+    """
+    Returns a TFLite interpreter with its tensors allocated.
+
+    Arguments:
+        tflite_model {bytes or str} -- Flatbuffer returned by convert_keras_model or path of a .tflite file
+
+    Keyword Arguments:
+        num_threads {int} -- Threads of the CPU kernels (default: {1}, the typical setting on a phone)
+        batch_size {int} -- Batch size the input is resized to (default: {None}, the batch size of the model)
+    """
+    if isinstance(tflite_model, bytes):
+        interpreter = tf.lite.Interpreter(model_content=tflite_model, num_threads=num_threads)
+    else:
+        interpreter = tf.lite.Interpreter(model_path=tflite_model, num_threads=num_threads)
+    if batch_size is not None:
+        input_details = interpreter.get_input_details()[0]
+        interpreter.resize_tensor_input(input_details["index"], [batch_size] + list(input_details["shape"][1:]))
+    interpreter.allocate_tensors()
+    return interpreter
+
+
+def predict(interpreter, X):
+    """
+    Runs the interpreter on a batch whose size matches its input and returns the output. The input and the output of
+    the models with integer inputs and outputs are quantized and dequantized with their scale and zero point.
+    """
+    input_details = interpreter.get_input_details()[0]
+    output_details = interpreter.get_output_details()[0]
+    if np.issubdtype(input_details["dtype"], np.integer):
+        scale, zero_point = input_details["quantization"]
+        X = np.round(np.asarray(X, dtype=np.float32) / scale + zero_point)
+    interpreter.set_tensor(input_details["index"], np.asarray(X, dtype=input_details["dtype"]))
+    interpreter.invoke()
+    output = interpreter.get_tensor(output_details["index"])
+    if np.issubdtype(output_details["dtype"], np.integer):
+        scale, zero_point = output_details["quantization"]
+        output = (output.astype(np.float32) - zero_point) * scale
+    return output
+
+
+def predict_samples(interpreter, X):
+    """
+    Runs an interpreter of batch size 1 on every window of X and returns the outputs.
+    """
+    return np.concatenate([predict(interpreter, X[index : index + 1]) for index in range(len(X))])
+
+
+def measure_latencies(run, num_warmup_runs=5, num_runs=50):
+    """
+    Calls run num_warmup_runs times and then returns the durations in milliseconds of num_runs calls.
+    """
+    for _ in range(num_warmup_runs):
+        run()
+    durations = np.empty(num_runs)
+    for i in range(num_runs):
+        start = time.perf_counter()
+        run()
+        durations[i] = time.perf_counter() - start
+    return 1000 * durations
+
+
+def measure_interpreter_latency(interpreter, num_warmup_runs=5, num_runs=50):
+    """
+    Returns the median latency in milliseconds of the interpreter on a random input.
+    """
+    input_details = interpreter.get_input_details()[0]
+    X = np.random.RandomState(0).randn(*input_details["shape"]).astype(input_details["dtype"])
+    interpreter.set_tensor(input_details["index"], X)
+    return float(np.median(measure_latencies(interpreter.invoke, num_warmup_runs, num_runs)))
+
+
+def compare_quantizations(model, X_test, y_test, representative_dataset, quantizations=QUANTIZATIONS, num_threads=1):
+    """
+    Converts the Keras model with every quantization and returns, for each of them, the test accuracy next to the one
+    of the Keras model, the fraction of the test windows whose predicted class is the same as with the Keras model, the
+    size of the .tflite file and the median latency of the interpreter on one window.
+    """
+    keras_predictions = model.predict(X_test, verbose=0)
+    keras_classes = np.argmax(keras_predictions, axis=1)
+    classes = np.argmax(y_test, axis=1)
+    results = []
+    for quantization in quantizations:
+        tflite_model = convert_keras_model(model, quantization, representative_dataset)
+        interpreter = make_interpreter(tflite_model, num_threads=num_threads)
+        predictions = predict_samples(interpreter, X_test)
+        predicted_classes = np.argmax(predictions, axis=1)
+        results.append(
+            {
+                "quantization": quantization,
+                "tflite_bytes": len(tflite_model),
+                "test_accuracy": float(np.mean(predicted_classes == classes)),
+                "keras_test_accuracy": float(np.mean(keras_classes == classes)),
+                "keras_agreement": float(np.mean(predicted_classes == keras_classes)),
+                "max_abs_difference": float(np.max(np.abs(predictions - keras_predictions))),
+                "latency_ms": measure_interpreter_latency(interpreter),
+            }
+        )
+    return results
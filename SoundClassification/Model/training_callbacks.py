@@ -0,0 +1,208 @@
+import csv
+import json
+import math
+import resource
+import sys
+import time
+
+import numpy as np
+import tensorflow as tf
+
+
+def get_peak_rss_mb():
+    """
+    Returns the peak resident set size of the process in megabytes.
+    """
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS and in kilobytes on Linux
+    return peak_rss / 1024 ** 2 if sys.platform == "darwin" else peak_rss / 1024
+
+
+class TrainingMetrics(tf.keras.callbacks.Callback):
+    """
+    Records the training throughput of every epoch and of a sample of batches, and writes it to a JSON file and to a
+    CSV file (one row per epoch) after every epoch.
+
+    The time of a step is split between the time Keras spends between two steps (input_wait, e.g. slicing the numpy
+    arrays or running a Python generator) and the time of the training step itself (compute). With a prefetched
+    tf.data.Dataset, the next batch is read inside the step, so an input stall shows up as compute time instead: compare
+    the throughput with measure_input_throughput in that case.
+
+    The callback must be the first one of the list given to fit: the time between its on_epoch_end and the beginning of
+    the next epoch is then the time of the other end of epoch callbacks, which is dominated by the checkpoint writes.
+    """
+
+    def __init__(self, json_path, csv_path, batch_size, batch_sample_every=10):
+        super().__init__()
+        self.json_path = json_path
+        self.csv_path = csv_path
+        self.batch_size = batch_size
+        self.batch_sample_every = batch_sample_every
+        self.epochs = []
+        self.batches = []
+
+    def on_epoch_begin(self, epoch, logs=None):
+        self._record_end_of_epoch_callbacks()
+        self.epoch_start = time.perf_counter()
+        self.last_batch_end = self.epoch_start
+        self.num_batches = 0
+        self.input_wait_time = 0
+        self.compute_time = 0
+
+    def on_train_batch_begin(self, batch, logs=None):
+        self.batch_start = time.perf_counter()
+        self.batch_input_wait_time = self.batch_start - self.last_batch_end
+        self.input_wait_time += self.batch_input_wait_time
+
+    def on_train_batch_end(self, batch, logs=None):
+        self.last_batch_end = time.perf_counter()
+        step_time = self.last_batch_end - self.batch_start
+        self.compute_time += step_time
+        if self.num_batches % self.batch_sample_every == 0:
+            self.batches.append(
+                {
+                    "epoch": len(self.epochs),
+                    "batch": self.num_batches,
+                    "step_time": step_time,
+                    "input_wait_time": self.batch_input_wait_time,
+                }
+            )
+        self.num_batches += 1
+
+    def on_epoch_end(self, epoch, logs=None):
+        epoch_end = time.perf_counter()
+        train_time = self.last_batch_end - self.epoch_start
+        self.epochs.append(
+            {
+                "epoch": epoch,
+                "num_batches": self.num_batches,
+                "train_time": train_time,
+                "samples_per_second": self.num_batches * self.batch_size / train_time,
+                "mean_step_time": self.compute_time / max(self.num_batches, 1),
+                "input_wait_time": self.input_wait_time,
+                "compute_time": self.compute_time,
+                "validation_time": epoch_end - self.last_batch_end,
+                "checkpoint_time": None,  # filled in when the next epoch begins
+                "peak_rss_mb": get_peak_rss_mb(),
+                "logs": {key: float(value) for key, value in (logs or {}).items()},
+            }
+        )
+        self.epoch_end = epoch_end
+
+    def on_train_end(self, logs=None):
+        self._record_end_of_epoch_callbacks()
+
+    def _record_end_of_epoch_callbacks(self):
+        if self.epochs and self.epochs[-1]["checkpoint_time"] is None:
+            self.epochs[-1]["checkpoint_time"] = time.perf_counter() - self.epoch_end
+            self.write()
+
+    def write(self):
+        with open(self.json_path, "w") as json_file:
+            metrics = {"batch_size": self.batch_size, "epochs": self.epochs, "batches": self.batches}
+            json.dump(metrics, json_file, indent=4)
+
+        columns = [column for column in self.epochs[0] if column != "logs"]
+        log_columns = sorted(self.epochs[0]["logs"])
+        with open(self.csv_path, "w", newline="") as csv_file:
+            writer = csv.writer(csv_file)
+            writer.writerow(columns + log_columns)
+            for epoch in self.epochs:
+                writer.writerow([epoch[column] for column in columns] + [epoch["logs"].get(key) for key in log_columns])
+
+
+class EpochSeeds(tf.keras.callbacks.Callback):
+    """
+    Reseeds the random operations of the model, e.g. the Dropout masks, at the beginning of every epoch with
+    random_state + epoch, so that a training resumed by ResumableCheckpoint draws the same masks as an uninterrupted
+    one. The layers drawing from their own seed generator (Keras 3) get the seed of the epoch and of their position.
+    """
+
+    def __init__(self, random_state):
+        super().__init__()
+        self.random_state = random_state
+
+    def on_epoch_begin(self, epoch, logs=None):
+        seed = self.random_state + epoch
+        tf.random.set_seed(seed)
+        for index, layer in enumerate(self.model.layers):
+            seed_generator = getattr(layer, "seed_generator", None)
+            if seed_generator is not None:
+                # The state is the (seed, counter) pair of the generator
+                state = np.array([seed * 1000 + index, 0]).astype(seed_generator.state.dtype)
+                seed_generator.state.assign(state)
+
+
+class ResumableCheckpoint(tf.keras.callbacks.Callback):
+    """
+    Saves the weights, the optimizer state (e.g. the Adam moments and the step counter), the number of completed epochs
+    and the best monitored value every save_every epochs, so that an interrupted training can be resumed with restore.
+
+    The best weights are only copied in memory when the monitored value improves. They are written to best_model_path
+    when a checkpoint is saved and at the end of the training, instead of blocking the training at every improvement,
+    so save_every bounds both the disk writes and the number of epochs lost by an interruption.
+    """
+
+    def __init__(self, model, checkpoint_dir, best_model_path, save_every=1, monitor="val_loss", max_to_keep=2):
+        super().__init__()
+        self.best_model_path = best_model_path
+        self.save_every = save_every
+        self.monitor = monitor
+        self.completed_epochs = tf.Variable(0, dtype=tf.int64, trainable=False)
+        self.best = tf.Variable(math.inf, dtype=tf.float64, trainable=False)
+        self.best_weights = None
+        self.checkpoint = tf.train.Checkpoint(
+            model=model, optimizer=model.optimizer, completed_epochs=self.completed_epochs, best=self.best
+        )
+        self.manager = tf.train.CheckpointManager(self.checkpoint, checkpoint_dir, max_to_keep=max_to_keep)
+
+    def restore(self):
+        """
+        Restores the latest checkpoint, if any, and returns the number of completed epochs, i.e. the initial_epoch of
+        model.fit. The optimizer slots are restored when they are created by the first training step.
+        """
+        if self.manager.latest_checkpoint is not None:
+            self.checkpoint.restore(self.manager.latest_checkpoint)
+            print("Resuming from {}".format(self.manager.latest_checkpoint))
+        return int(self.completed_epochs.numpy())
+
+    def on_epoch_end(self, epoch, logs=None):
+        value = (logs or {}).get(self.monitor)
+        if value is not None and value < self.best.numpy():
+            self.best.assign(value)
+            self.best_weights = self.model.get_weights()
+
+        self.completed_epochs.assign(epoch + 1)
+        if (epoch + 1) % self.save_every == 0:
+            self.manager.save(checkpoint_number=epoch + 1)
+            self._write_best_model()
+
+    def on_train_end(self, logs=None):
+        self._write_best_model()
+
+    def _write_best_model(self):
+        if self.best_weights is None:
+            return
+        weights = self.model.get_weights()
+        self.model.set_weights(self.best_weights)
+        self.model.save(self.best_model_path)
+        self.model.set_weights(weights)
+        self.best_weights = None
+
+
+def measure_input_throughput(dataset, num_batches=50):
+    """
+    Returns the number of batches per second that a tf.data.Dataset yields on its own, without any model. If it is
+    close to the training steps per second, the training is limited by the input pipeline.
+    """
+    iterator = iter(dataset)
+    next(iterator)  # the first batch includes the start of the pipeline
+    start = time.perf_counter()
+    num_read_batches = 0
+    for _ in range(num_batches):
+        try:
+            next(iterator)
+        except StopIteration:
+            break
+        num_read_batches += 1
+    return num_read_batches / (time.perf_counter() - start)